@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import platform
+import resource
+import subprocess
+import tempfile
+import numpy as np
+import rasterio as rio
+import multiprocessing as mp
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from shutil import copytree, rmtree
+from fastcore.script import *
+from src.functions import *
+from src.numpy_utils import nan_percentile
+from src.cube import meta_file
+from src.synthetic import *
+
+import logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+"""
+Benchmarks for the gap filling and stats functions and a whole `process_patch` on synthetic
+S2ind-like mosaics. Each case is run in a fresh process, so that its peak memory is measured
+alone. Results are appended to a JSON lines file with a version label, and the latest run is
+compared to the previous version in the file.
+"""
+
+CASES = ['fill_prev_years', 'fill_base', 'fill_adjacent_months', 'make_stats', 'make_amplitude',
+         'nan_percentile', 'process_patch']
+
+def stage_tempdata(files:list, ndindex:str, datapath:Path) -> None:
+    "Write `files` to `datapath`/<year> the way `process_patch` stages them, with nodata 255 for NDBI"
+    for f in files:
+        with rio.open(f) as src:
+            prof = src.profile
+            vals = src.read(1)
+        if ndindex == 'ndbi':
+            with rio.open(meta_file(f)) as meta:
+                vals[meta.read(1, masked=True).mask] = 255
+            prof['nodata'] = 255
+        os.makedirs(datapath/f.parts[-3], exist_ok=True)
+        with rio.open(datapath/f.parts[-3]/f.name, 'w', **prof) as dest:
+            dest.write(vals, 1)
+    return
+
+def write_base(datapath:Path, years:list, months:list, fname:Path) -> None:
+    "Write the median of `months` of all `years` in `datapath` to `fname`, like the base mosaics of `process_patch`"
+    vals = []
+    for year in years:
+        for f in sorted((datapath/str(year)).glob('*.tif')):
+            if int(f.stem.split('_')[-2][4:6]) not in months: continue
+            with rio.open(f) as src:
+                vals.append(src.read(1, masked=True))
+                prof = src.profile
+    base = np.zeros(vals[0].shape, dtype=np.uint8)
+    _ = np.ma.median(np.ma.array(vals), axis=0, out=base)
+    with rio.open(fname, 'w', **prof) as dest:
+        dest.write(base, 1)
+    return
+
+def prepare(datapath:Path, ndindex:str, years:list, size:int) -> list:
+    """Generate synthetic mosaics of `size`x`size` pixels in `datapath`/in unless they exist, and the
+    intermediate products of the file-based chain that the cases start from. Returns the mosaics"""
+    inpath = datapath/'in'
+    files = sorted(inpath.glob(f'*/{ndindex.upper()}/*.tif'))
+    if files:
+        with rio.open(files[0]) as src:
+            if src.width != size: raise ValueError(f'Mosaics in {inpath} are not {size}x{size} pixels')
+    else:
+        logging.info(f'Generating {size}x{size} synthetic mosaics to {inpath}')
+        files = synthetic_mosaics(inpath, ndindex, years, size, size)
+    prepared = datapath/'prepared'/ndindex
+    if prepared.exists(): return files
+    logging.info('Preparing intermediate products')
+    stage_tempdata(files, ndindex, prepared/'tempdata')
+    write_base(prepared/'tempdata', years, [4, 5], prepared/'base_spring.tif')
+    write_base(prepared/'tempdata', years, [10], prepared/'base_autumn.tif')
+    fill_prev_years(prepared/'tempdata', prepared/'interp_prev', years[2:])
+    copytree(prepared/'interp_prev', prepared/'interp_base')
+    monthly = monthly_files(files, years[2:])
+    fill_base(prepared/'interp_base', prepared/'base_spring.tif', monthly)
+    fill_base(prepared/'interp_base', prepared/'base_autumn.tif', monthly)
+    copytree(prepared/'interp_base', prepared/'interp_filled')
+    for m in range(5, 10):
+        fill_adjacent_months(prepared/'interp_filled', m, monthly)
+    return files
+
+def setup_case(case:str, prepared:Path, work:Path, years:list, files:list, ndindex:str, size:int):
+    "Prepare the inputs of `case` in `work` and return the call to benchmark"
+    if case == 'fill_prev_years':
+        return partial(fill_prev_years, prepared/'tempdata', work/'interp', years[2:])
+    if case == 'fill_base':
+        copytree(prepared/'interp_prev', work/'interp')
+        monthly = monthly_files(files, years[2:])
+        return lambda: [fill_base(work/'interp', prepared/f'base_{s}.tif', monthly) for s in ('spring', 'autumn')]
+    if case == 'fill_adjacent_months':
+        copytree(prepared/'interp_base', work/'interp')
+        monthly = monthly_files(files, years[2:])
+        return lambda: [fill_adjacent_months(work/'interp', m, monthly) for m in range(5, 10)]
+    if case == 'make_stats':
+        return partial(make_stats, prepared/'interp_filled', work/'stats')
+    if case == 'make_amplitude':
+        mosaics, prof = read_stack(prepared/'interp_filled'/str(years[-1]))
+        yearly_max = np.ma.masked_equal(mosaics, prof['nodata']).max(axis=0)
+        return partial(make_amplitude, prepared/'interp_filled', yearly_max, years[-1])
+    if case == 'nan_percentile':
+        mosaics, prof = read_stack(prepared/'interp_filled'/str(years[-1]))
+        arr = np.where(mosaics == prof['nodata'], np.nan, mosaics.astype(np.float32))
+        return partial(nan_percentile, arr, [10, 25])
+    if case == 'process_patch':
+        from process_files import process_patch
+        os.makedirs(work/ndindex/'base_mosaics', exist_ok=True)
+        with rio.open(files[0]) as src:
+            prof = src.profile
+        return partial(process_patch, work, years, files, ndindex, 0, 0, size, size, prof)
+    raise ValueError(f'Unknown case {case}')
+
+def run_case(case:str, prepared:Path, work:Path, years:list, files:list, ndindex:str, size:int) -> dict:
+    "Run `case` once, in a worker process of its own, and return its wall and CPU time and peak memory"
+    os.makedirs(work, exist_ok=True)
+    func = setup_case(case, prepared, work, years, files, ndindex, size)
+    setup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    wall, cpu = time.perf_counter(), time.process_time()
+    func()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    rmtree(work)
+    return {'wall_s': round(wall, 3), 'cpu_s': round(cpu, 3),
+            'setup_rss_mb': round(setup_rss / 1024, 1),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+def git_label() -> str:
+    "Short description of the checked out version, or 'unknown' outside a git repository"
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.realpath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def report(results:Path, label:str, ndindex:str, size:int) -> None:
+    "Log the fastest run of each case for `label` and its ratio to the previous version in `results`"
+    with open(results) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    rows = [r for r in rows if r['ndindex'] == ndindex and r['size'] == size]
+    labels = list(dict.fromkeys(r['label'] for r in rows))
+    prev = labels[labels.index(label) - 1] if labels.index(label) > 0 else None
+    def best(lbl, case, key): return min((r[key] for r in rows if r['label'] == lbl and r['case'] == case), default=None)
+    logging.info(f'{size}x{size} {ndindex}, {label}' + (f' compared to {prev}' if prev else ''))
+    for case in dict.fromkeys(r['case'] for r in rows if r['label'] == label):
+        line = f'{case:<22}'
+        for key, unit in (('wall_s', 's'), ('cpu_s', 's cpu'), ('peak_rss_mb', 'MB')):
+            cur, old = best(label, case, key), best(prev, case, key)
+            line += f'{cur:>10.2f} {unit}' + (f' ({cur/old:.2f}x)' if old else ' ' * 8)
+        logging.info(line)
+    return
+
+@call_parse
+def main(results:Param('JSON lines file to append the results to', str, default='benchmark_results.jsonl'),
+         size:Param('Width and height of the synthetic mosaics in pixels', int, default=1000),
+         ndindex:Param('Index of the synthetic mosaics, NDBI has META masks', str, default='ndvi',
+                       choices=['ndvi', 'ndbi']),
+         cases:Param('Cases to run, default all', str, nargs='+', default=CASES, choices=CASES),
+         repeats:Param('Number of runs of each case', int, default=3),
+         datapath:Param("""Path for the synthetic mosaics, which are reused if they exist.
+                        Default a temporary directory that is removed afterwards""", str, default=''),
+         label:Param('Label of the results, default the git version', str, default='')):
+    years = list(range(2016, 2023))
+    cases = [cases] if isinstance(cases, str) else list(cases)
+    label = label or git_label()
+    tmpdir = None if datapath else tempfile.mkdtemp()
+    datapath = Path(datapath or tmpdir).absolute()
+    files = prepare(datapath, ndindex, years, size)
+    with open(results, 'a') as out:
+        for case in cases:
+            for repeat in range(repeats):
+                # A fresh process per run, so that peak memory is that of the case only
+                with ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as executor:
+                    res = executor.submit(run_case, case, datapath/'prepared'/ndindex, datapath/'work',
+                                          years, files, ndindex, size).result()
+                logging.info(f'{case} run {repeat+1}/{repeats}: {res["wall_s"]} s, {res["peak_rss_mb"]} MB')
+                out.write(json.dumps({'label': label, 'date': datetime.now().isoformat(timespec='seconds'),
+                                      'host': platform.node(), 'cpus': os.cpu_count(), 'case': case,
+                                      'ndindex': ndindex, 'size': size, 'repeat': repeat, **res}) + '\n')
+                out.flush()
+    if tmpdir: rmtree(tmpdir)
+    report(Path(results), label, ndindex, size)
@@ -7,14 +7,22 @@ from pathlib import Path
 from shutil import rmtree
 from fastcore.script import *
 from src.functions import *
+from src.cube import *
+from src.tiling import *
+from src.mosaic import *
+from src.scheduler import *
+from src.manifest import *
+from src.metrics import *
+from src.reader import *
+from src.numpy_utils import uint8_median
+from src.catalog import *
+from src.timeseries import *
+from src.zarr_store import *
 
 import rasterio.windows as rio_windows
 import rasterio.merge as rio_merge
 import geopandas as gpd
 from rasterio.enums import Resampling
-from shapely.geometry import box
-from itertools import product
-import multiprocessing
 
 import logging
 logging.basicConfig(
@@ -44,249 +52,518 @@ def get_script_path():
     return os.path.dirname(os.path.realpath(sys.argv[0]))
 
 def rio_merge_files(files_to_mosaic, outpath):
-    "Merge files, used with multiprocessing.Pool"
+    "Merge files, used as a task of `run_tasks`"
     logging.info(f'Creating file {outpath.parts[-2]}/{outpath.stem}')
     rio_merge.merge(files_to_mosaic, dst_path=outpath,
                     dst_kwds={'compress':'lzw', 'predictor':2, 'BIGTIFF':'YES'})
     return
 
 def patch_build_overviews(fname):
-    "Build overviews to mosaics, used with multiprocessing.Pool"
+    "Build overviews to mosaics, used as a task of `run_tasks`"
     logging.info(f'Building overviews for {fname.parts[-2]}/{fname.stem}')
-    factors = [2**(n+1) for n in range(9)]
     dst = rio.open(fname, 'r+')
-    dst.build_overviews(factors, Resampling.nearest)
+    dst.build_overviews(OVERVIEW_FACTORS, Resampling.nearest)
     dst.update_tags(ns='rio_overview', resampling='nearest')
     dst.close()
     return 
 
-def process_patch(outpath:Path, years:list, files:list, ndindex:str, x:int, y:int, dx:int, dy:int) -> None:
+def process_patch(outpath:Path, years:list, files:list, ndindex:str, x:int, y:int, dx:int, dy:int, prof:dict,
+                  outside:np.ndarray=None, scratch:Path=None) -> None:
     """
     Process 10000x9900 patches and compute stats from them. By default, products for 
     2018, 2019, 2020 and 2021 are produced, using data from 2016 to 2021
 
-    1. Check if the window is within Finnish borders. If not, skip it
-    2. Extract 10000x9900 patches from the full mosaics 
-    3. Construct basemosaics for spring (April-May) and autumn (mid-September - October). Basemosaics
+    1. Extract 10000x9900 patches from the full mosaics 
+    2. Construct basemosaics for spring (April-May) and autumn (mid-September - October). Basemosaics
        contain the pixelwise median values from the full data availability period
-    4. Fill all nodata with the maximum value for the same month and pixel from two previous years
-    5. Fill all remaining nodata for April and May mosaics with spring basemosaic
-    6. Fill all remaining nodata for October with autumn basemosaic
-    7. Fill all remaining nodata for May-September with the mean value of the adjacent months of the same year
-    8. Collate yearly statistics
-    9. Clip products to Finnish borders, if necessary.
+    3. Fill all nodata with the maximum value for the same month and pixel from two previous years
+    4. Fill all remaining nodata for April and May mosaics with spring basemosaic
+    5. Fill all remaining nodata for October with autumn basemosaic
+    6. Fill all remaining nodata for May-September with the mean value of the adjacent months of the same year
+    7. Collate yearly statistics
+    8. Set pixels `outside` Finnish borders to nodata, if given.
+
+    Windows outside the borders are skipped by `main`, which also gives the border masks of the
+    windows that are partly outside from `plan_tiles`. Base mosaics and stats are masked as they are
+    written, and the filled monthly mosaics once they are finished.
+
+    `prof` is the profile of the input mosaics, from the catalog, so that the workers do not open
+    them just to read it. The windows for base mosaics are memory-mapped in directory `scratch` if given.
     """
     logging.info(f'Starting with raster {x}_{y}')
+    metrics = StageMetrics(f'{x}_{y}', ndindex)
+    metrics.start('staging')
     ix_path = outpath/ndindex
     base_datapath = ix_path/'base_mosaics'
     datapath = ix_path/f'tempdata_{x}_{y}'
     os.makedirs(datapath, exist_ok=True)
-    borders = gpd.read_file(f'{get_script_path()}/aux_data/fin_borders.shp')
 
     for year in years: os.makedirs(datapath/str(year), exist_ok=True)
     window = rio_windows.Window.from_slices((y, y+dy), (x, x+dx))
-    for f in files:
+    spring_files = sorted([t for t in files if mosaic_date(t)[1] in (4, 5)])
+    autumn_files = sorted([t for t in files if mosaic_date(t)[1] == 10])
+    prof = prof.copy()
+    prof.update(
+        height=window.height,
+        width=window.width,
+        transform= rio_windows.transform(window, prof['transform']),
+        compress='lzw',
+        predictor=2,
+        BIGTIFF='YES'
+    )
+    if ndindex == 'ndbi': prof['nodata'] = 255
+    if prof['nodata'] is None: prof['nodata'] = 0
+    nodata = prof['nodata']
+    # Next windows are read in the background while the current one is written, and the windows
+    # for base mosaics are kept in a stack with gaps as nodata, so that they are read only once
+    base_files = spring_files + autumn_files
+    base_stack = scratch_array((len(base_files), dy, dx), scratch)
+    reads = prefetch(lambda f: read_window(f, window, ndindex), files)
+    for f, (vals, mask, _) in zip(files, reads):
         year = str(f).split(f'{ndindex}_')[1][:4]
-        with rio.open(f) as src:
-            prof = src.profile.copy()
-            prof.update(
-                height=window.height,
-                width=window.width,
-                transform= rio_windows.transform(window, src.transform),
-                compress='lzw',
-                predictor=2,
-                BIGTIFF='YES'
-            )
-            # If window is not within Finnish borders, no need to process it
-            bbox = box(prof['transform'][2],
-                       prof['transform'][5]+prof['transform'][4]*window.height,
-                       prof['transform'][2]+prof['transform'][0]*window.width,
-                       prof['transform'][5])
-
-            if not bbox.intersects(borders.iloc[0].geometry):
-                logging.info(f'Window {x}_{y} outside Finnish borders, skipping..')
-                rmtree(datapath)
-                return
-
-            with rio.open(datapath/year/f.name, 'w', **prof) as dest:
-                dest.write(src.read(window=window)[0],1)
-            if ndindex == 'ndbi': # For ndbi 0 can be either nodata or valid value so we need nodatamask from metadata
-                with rio.open(str(f).replace('ndbi', 'meta').replace('NDBI', 'META')) as meta:
-                    meta_mask = meta.read(window=window, masked=True)[0]
-                with rio.open(datapath/year/f.name, 'r+', **prof) as src:
-                    src.nodata = 255
-                    vals = src.read()[0]
-                    vals[meta_mask.mask] = 255
-                    src.write(vals,1)
+        # For ndbi 0 can be either nodata or valid value so the nodata mask comes from metadata
+        vals[mask] = nodata
+        if f in base_files: base_stack[base_files.index(f)] = vals
+        with rio.open(datapath/year/f.name, 'w', **prof) as dest:
+            dest.write(vals,1)
 
     logging.info(f'Creating base mosaics for {x}_{y}')
-    spring_files = sorted([t for t in files if 
-                           any(mon in str(t) for mon in ('0430', '0515', '0531'))])
-    autumn_files = sorted([t for t in files if 
-                           any(mon in str(t) for mon in ('1015', '1031'))])
-    spring_vals = []
-    for f in spring_files:
-        with rio.open(f) as src:
-            if ndindex != 'ndbi':
-                spring_vals.append(src.read(window=window, masked=True)[0])
-            else:
-                with rio.open(str(f).replace('ndbi', 'meta').replace('NDBI', 'META')) as meta:
-                    meta_mask = meta.read(window=window, masked=True)[0]
-                tmp = src.read(window=window)[0]
-                tmp[meta_mask.mask] = 255
-                spring_vals.append(np.ma.array(src.read(window=window)[0], mask=meta_mask.mask))
-                prof['nodata'] = 255
-
-    spring_vals = np.ma.array(spring_vals)
-    spring_base = np.zeros((dy,dx), dtype=np.uint8)
-    _ = np.ma.median(spring_vals, axis=0, out=spring_base)
-    with rio.open(base_datapath/f'base_spring_{x}_{y}.tif', 'w', **prof) as dest:
-        dest.write(spring_base, 1)
-
-    autumn_vals = []
-    for f in autumn_files:
-        with rio.open(f) as src:
-            if ndindex != 'ndbi':
-                autumn_vals.append(src.read(window=window, masked=True)[0])
-            else:
-                with rio.open(str(f).replace('ndbi', 'meta').replace('NDBI', 'META')) as meta:
-                    meta_mask = meta.read(window=window, masked=True)[0]
-                tmp = src.read(window=window)[0]
-                tmp[meta_mask.mask] = 255
-                autumn_vals.append(np.ma.array(src.read(window=window)[0], mask=meta_mask.mask))
-
-    autumn_vals = np.ma.array(autumn_vals)
-    autumn_base = np.zeros((dy,dx), dtype=np.uint8)
-    _ = np.ma.median(autumn_vals, axis=0, out=autumn_base)
-    with rio.open(base_datapath/f'base_autumn_{x}_{y}.tif', 'w', **prof) as dest:
-        dest.write(autumn_base, 1)
-
-    vals = np.ma.concatenate([spring_vals, autumn_vals], 0)
-    base = np.zeros((dy,dx), dtype=np.uint8)
-    _ = np.ma.median(vals, axis=0, out=base)
-    with rio.open(base_datapath/f'base_all_{x}_{y}.tif', 'w', **prof) as dest:
-        dest.write(base, 1)
-
-    del spring_vals 
-    del autumn_vals 
-    del vals 
-    del autumn_base  
-    del spring_base
+    metrics.start('base_mosaics')
+    for name, stack in (('spring', base_stack[:len(spring_files)]),
+                        ('autumn', base_stack[len(spring_files):]),
+                        ('all', base_stack)):
+        base = uint8_median(stack, nodata)
+        if outside is not None: base[outside] = nodata
+        with rio.open(base_datapath/f'base_{name}_{x}_{y}.tif', 'w', **prof) as dest:
+            dest.write(base, 1)
+    del base_stack
     del base
 
     logging.info(f'Filling nodata values for {x}_{y}')
 
     filled_path = ix_path/f'interp_{x}_{y}'
 
-    fillyears = [
-        2018,
-        2019,
-        2020,
-        2021,
-        2022
-    ]
+    fillyears = years[2:]
+    monthly = monthly_files(files, fillyears)
 
+    metrics.start('fill_prev_years')
     fill_prev_years(datapath, filled_path, fillyears)
-    fill_base(filled_path, base_datapath/f'base_spring_{x}_{y}.tif')
-    fill_base(filled_path, base_datapath/f'base_autumn_{x}_{y}.tif')
+    metrics.start('fill_base')
+    fill_base(filled_path, base_datapath/f'base_spring_{x}_{y}.tif', monthly)
+    fill_base(filled_path, base_datapath/f'base_autumn_{x}_{y}.tif', monthly)
     rmtree(datapath)
+    metrics.start('fill_adjacent_months')
     for m in range(5, 10):
-        fill_adjacent_months(filled_path, m)
+        fill_adjacent_months(filled_path, m, monthly)
     logging.info(f'Creating statistics rasters {x}_{y}')
+    metrics.start('stats')
     statspath = ix_path/f'stats_{x}_{y}'
-    make_stats(filled_path, statspath, base_datapath/f'base_all_{x}_{y}.tif')
+    make_stats(filled_path, statspath, outside)
 
-    if not bbox.within(borders.iloc[0].geometry):
+    if outside is not None:
         logging.info(f'Clipping rasters {x}_{y}')
-        clip_rasters(filled_path, borders, fillyears)
-        clip_rasters(statspath, borders, fillyears)
-        clip_raster(base_datapath/f'base_spring_{x}_{y}.tif', borders)
-        clip_raster(base_datapath/f'base_autumn_{x}_{y}.tif', borders)
-        clip_raster(base_datapath/f'base_all_{x}_{y}.tif', borders)
+        metrics.start('clip')
+        mask_rasters(filled_path, outside, monthly)
+    metrics.stop()
+    logging.info(f'Finished with raster {x}_{y}')
+    return
+
+STATS = ['mean', 'median', 'min', 'max', 'quantile_10', 'quantile_25', 'sum']
+
+# Spatial gap filling searches valid values up to MAX_DISTANCE pixels away and smooths them SMOOTHING
+# times with a 3x3 mean, so tiles are read with a halo of SPATIAL_HALO pixels to get seamless results
+MAX_DISTANCE = 100
+SMOOTHING = 3
+SPATIAL_HALO = MAX_DISTANCE + SMOOTHING
+
+def national_products(ix_path:Path, years:list, files:list, prof:dict) -> dict:
+    """
+    Paths and profiles of all national mosaics produced from `files`: base mosaics, filled monthly
+    mosaics in `interp/<year>` and yearly stats in `stats/<year>`. `prof` is the profile of the uint8
+    mosaics, amplitude and sum are int16 with nodata -999
+    """
+    stat_prof = prof.copy()
+    stat_prof.update({'dtype':'int16', 'nodata': -999})
+    products = {ix_path/f'base_{name}.tif': prof for name in ('spring', 'autumn', 'all')}
+    for f in files:
+        if mosaic_date(f)[0] in years[2:]:
+            products[ix_path/'interp'/str(mosaic_date(f)[0])/f.name] = prof
+    for year in years[2:]:
+        for name in STATS + (['amp'] if has_amplitude(year, years[2:]) else []):
+            products[ix_path/'stats'/str(year)/f'{name}.tif'] = stat_prof if name in ('amp', 'sum') else prof
+    return products
+
+def product_inputs(ix_path:Path, years:list, files:list, ndindex:str) -> dict:
+    """
+    Input mosaics of each product of `national_products`. Base mosaics use the spring or autumn
+    mosaics of all years. The filled mosaics of a year use the base mosaics and all mosaics of the
+    year and the two previous years, and stats additionally those of the previous year for amplitude.
+    For NDBI, the META mosaics are inputs as well
+    """
+    mosaics = files + ([Path(meta_file(f)) for f in files] if ndindex == 'ndbi' else [])
+    spring = [f for f in mosaics if mosaic_date(f)[1] in (4, 5)]
+    autumn = [f for f in mosaics if mosaic_date(f)[1] == 10]
+    filled = {year: spring + autumn + [f for f in mosaics if year-2 <= mosaic_date(f)[0] <= year]
+              for year in years[2:]}
+    inputs = {ix_path/'base_spring.tif': spring,
+              ix_path/'base_autumn.tif': autumn,
+              ix_path/'base_all.tif': spring + autumn}
+    for f in files:
+        if mosaic_date(f)[0] in years[2:]:
+            inputs[ix_path/'interp'/str(mosaic_date(f)[0])/f.name] = filled[mosaic_date(f)[0]]
+    for year in years[2:]:
+        amp = has_amplitude(year, years[2:])
+        for name in STATS + (['amp'] if amp else []):
+            inputs[ix_path/'stats'/str(year)/f'{name}.tif'] = filled[year] + (filled[year-1] if amp else [])
+    return inputs
+
+def write_product(fname:Path, vals:np.ndarray, nodata:int, tile:Tile, outside:np.ndarray=None) -> None:
+    "Write `vals` to the window of `tile` in national mosaic `fname`, setting pixels `outside` Finnish borders to nodata"
+    if outside is not None:
+        vals = np.where(outside, nodata, vals)
+    write_window(fname, vals, tile.window, OVERVIEW_FACTORS)
+    return
+
+def process_tile(outpath:Path, years:list, files:list, ndindex:str, tile:Tile, prof:dict, products:dict=None,
+                 spatial_fill:bool=False, scratch:Path=None, backend:str='geotiff') -> None:
+    """
+    In-memory version of `process_patch` for a tile from `plan_tiles`. The window is read
+    once into a (year, month, y, x) cube, the gaps are filled and stats collated in memory,
+    and each product is written exactly once, straight into its window of the national mosaic
+    created by `main`. `prof` is the profile of the input mosaics from the catalog. Partial tiles are clipped with the border mask of the plan before writing.
+    If `products` is given, only those are written and only the years they need are filled.
+    With `spatial_fill`, the gaps remaining after filling from previous years are filled from
+    nearby pixels, reading the tile with a halo so that there are no seams between tiles.
+    The cube is memory-mapped in directory `scratch` if given. With the 'zarr' `backend`, products
+    are written to the Zarr store of the index instead of the national mosaics.
+    """
+    x, y = tile.x, tile.y
+    logging.info(f'Starting with raster {x}_{y}')
+    metrics = StageMetrics(tile.name, ndindex)
+    metrics.start('staging')
+    ix_path = outpath/ndindex
+    write = ZarrProducts(ix_path/ZARR_STORE).write if backend == 'zarr' else write_product
+    months = sorted({mosaic_date(f)[1] for f in files})
+    names = {mosaic_date(f): f.name for f in files}
+    window = tile.halo_window(SPATIAL_HALO if spatial_fill else 0, prof['width'], prof['height'])
+    inner = np.s_[..., tile.y-window.row_off:tile.y-window.row_off+tile.dy,
+                  tile.x-window.col_off:tile.x-window.col_off+tile.dx]
+    cube, prof = stage_cube(files, ndindex, window, prof, years, months, scratch)
+    nodata = prof['nodata']
+    outside = tile.outside_mask()
+    if products is None: products = national_products(ix_path, years, files, prof)
+    interp_years = {int(f.parent.name) for f in products if f.parent.parent == ix_path/'interp'}
+    stats_years = {int(f.parent.name) for f in products if f.parent.parent == ix_path/'stats'}
+    fill_years = interp_years | stats_years | {year-1 for year in stats_years if has_amplitude(year, years[2:])}
+
+    logging.info(f'Creating base mosaics for {x}_{y}')
+    metrics.start('base_mosaics')
+    spring_idx = [months.index(m) for m in (4, 5)]
+    autumn_idx = [months.index(10)]
+    bases = {'spring': base_median(cube[inner], nodata, spring_idx),
+             'autumn': base_median(cube[inner], nodata, autumn_idx),
+             'all': base_median(cube[inner], nodata, spring_idx + autumn_idx)}
+    for name, base in bases.items():
+        if ix_path/f'base_{name}.tif' in products:
+            write(ix_path/f'base_{name}.tif', base, nodata, tile, outside)
+
+    logging.info(f'Filling nodata values for {x}_{y}')
+    fill_idx = [years.index(year) for year in sorted(fill_years)]
+    metrics.start('fill_prev_years')
+    fill_prev_years_cube(cube, nodata, fill_idx)
+    if spatial_fill:
+        metrics.start('fill_spatial')
+        fill_spatial_cube(cube, nodata, fill_idx, MAX_DISTANCE, SMOOTHING)
+    cube = cube[inner]
+    metrics.start('fill_base')
+    fill_base_cube(cube, nodata, bases['spring'], fill_idx, spring_idx)
+    fill_base_cube(cube, nodata, bases['autumn'], fill_idx, autumn_idx)
+    del bases
+    metrics.start('fill_adjacent_months')
+    for m in range(5, 10):
+        fill_adjacent_months_cube(cube, nodata, fill_idx, months.index(m))
+
+    metrics.start('write_interp')
+
+    for i in fill_idx:
+        for j, month in enumerate(months):
+            if (years[i], month) not in names: continue
+            fname = ix_path/'interp'/str(years[i])/names[years[i], month]
+            if fname in products: write(fname, cube[i, j], nodata, tile, outside)
+
+    logging.info(f'Creating statistics rasters {x}_{y}')
+    metrics.start('stats')
+    for i in fill_idx:
+        if years[i] not in stats_years: continue
+        stats = collate_stats(cube[i], nodata, cube[i-1] if has_amplitude(years[i], years[2:]) else None)
+        for name, vals in stats.items():
+            fname = ix_path/'stats'/str(years[i])/f'{name}.tif'
+            if fname in products: write(fname, vals, -999 if name in ('amp', 'sum') else nodata, tile, outside)
+        del stats
+    metrics.stop()
     logging.info(f'Finished with raster {x}_{y}')
     return
 
+def process_tile_batch(outpath:Path, years:list, files:dict, profiles:dict, tile:Tile, products:dict,
+                       spatial_fill:bool=False, scratch:Path=None, backend:str='geotiff') -> None:
+    """
+    Process `tile` with `process_tile` for the indices in `products`, a dict of index and the
+    products to write with their input fingerprints, and record them in the manifest. `files` and
+    `profiles` are dicts of index and its files and their profile. Used as a task of `run_tasks`
+    """
+    for ndindex, ix_products in products.items():
+        process_tile(outpath, years, files[ndindex], ndindex, tile, profiles[ndindex], ix_products, spatial_fill,
+                     scratch, backend)
+        record_tile(outpath, tile, ix_products)
+    return
+
+def process_patch_tile(outpath:Path, years:list, files:list, ndindex:str, tile:Tile, prof:dict, products:dict,
+                       scratch:Path=None) -> None:
+    "Process `tile` with `process_patch` and record its `products` in the manifest, used as a task of `run_tasks`"
+    process_patch(outpath, years, files, ndindex, tile.x, tile.y, tile.dx, tile.dy, prof, tile.outside_mask(), scratch)
+    record_tile(outpath, tile, products)
+    return
+
+def finish_product(outpath:Path, fname:Path, fp:str, func, *args) -> None:
+    "Finish national mosaic `fname` with `func(*args)` and record it in the manifest, used as a task of `run_tasks`"
+    metrics = StageMetrics(str(fname.relative_to(outpath)))
+    metrics.start(func.__name__)
+    func(*args)
+    metrics.stop()
+    record_product(outpath, fname, fp)
+    return
+
+def merge_product(ix_path:Path, fname:Path) -> None:
+    "Merge the per-tile pieces of national mosaic `fname`, relative to `ix_path`, produced by `process_patch`"
+    if len(fname.parts) == 1:
+        patches = sorted((ix_path/'base_mosaics').glob(f'{fname.stem}_*.tif'))
+    else:
+        patches = sorted(ix_path.glob(f'{fname.parts[0]}_*/{fname.parts[1]}/{fname.name}'))
+    os.makedirs((ix_path/fname).parent, exist_ok=True)
+    metrics = StageMetrics(str(fname), ix_path.name)
+    metrics.start('merge')
+    rio_merge_files(patches, ix_path/fname)
+    metrics.stop()
+    return
+
+def remove_patches(ix_path:Path) -> None:
+    "Remove the per-tile products of `process_patch` after merging"
+    rmtree(ix_path/'base_mosaics', ignore_errors=True)
+    for f in os.listdir(ix_path):
+        if 'interp_' in f or 'stats_' in f: rmtree(ix_path/f)
+    return
 
 @call_parse
-def main(ndindex:Param("""Normalized difference index to use, 
-                       must be one of ndvi, ndmi, ndti, ndbi or ndsi.
-                       Default ndvi""", str, default='ndvi',
+def main(ndindex:Param("""Normalized difference indices to use, 
+                       one or more of ndvi, ndmi, ndti, ndbi or ndsi.
+                       Default ndvi""", str, nargs='+', default=['ndvi'],
                        choices=['ndvi', 'ndmi', 'ndbi', 'ndti', 'ndsi']),
          outpath:Param('Path to save generated data to. default "."',
                        str, default='.'),
-         inpath:Param('Path that contains all the required files', str)):
+         inpath:Param('Path that contains all the required files', str),
+         in_memory:Param("""Process tiles in memory instead of through temporary files. 
+                         With several indices, each tile is processed for all of them in one visit""",
+                         store_true),
+         spatial_fill:Param("""Fill the gaps that remain after filling from previous years from valid pixels 
+                            within 100 pixels, before filling from base mosaics. Requires --in_memory""",
+                            store_true),
+         codec:Param('Compression of the Cloud-Optimized GeoTIFFs produced with --in_memory. Default deflate',
+                     str, default='deflate', choices=['deflate', 'zstd', 'lzw']),
+         workers:Param('Number of worker processes. Default: number of cores', int, default=0),
+         mem_gb:Param('Memory budget for the workers in GB. Default: 80% of physical memory',
+                      float, default=0),
+         metrics:Param("""JSON lines file to append the time, I/O and peak memory of each processing stage
+                       of each tile to. A summary is logged at the end. Default no metrics""", str, default=''),
+         scratch:Param("""Directory on a local disk for memory-mapped scratch files of the per-tile stacks, which
+                       lowers the memory needed per tile so that more workers fit in the memory budget.
+                       Default keep them in memory""", str, default=''),
+         shard:Param("""Process only shard i of n of the tiles, given as i/n with i from 0 to n-1, so that
+                     independent runs on several hosts can share the output path. Mosaics are finished
+                     by a run without --shard once all shards have exited""", str, default=''),
+         timeseries:Param("""Also stack the filled monthly mosaics into <index>/timeseries.tif, with the series
+                          of each pixel in one block for fast queries with `src.timeseries.TimeSeries`""",
+                          store_true),
+         backend:Param("""Output format of the products. With zarr, all products of an index are written to
+                       <index>/products.zarr in chunks that the tiles write in parallel, without finishing
+                       national mosaics. zarr requires --in_memory. Default geotiff""",
+                       str, default='geotiff', choices=['geotiff', 'zarr'])):
 
     inpath = Path(inpath)
     outpath = Path(outpath)
-    years = [2016, 2017,2018,2019,2020,2021,2022]
-    files = []
-    for year in years:
-        files.extend([inpath/f'{year}/{ndindex.upper()}/{f}'
-                      for f in os.listdir(inpath/f'{year}/{ndindex.upper()}')
-                      if '15' not in f])
-    files = [f for f in files if str(f).endswith('tif')]
+    scratch = Path(scratch) if scratch else None
+    if scratch: os.makedirs(scratch, exist_ok=True)
+    ndindices = [ndindex] if isinstance(ndindex, str) else list(ndindex)
+    workers = workers or os.cpu_count()
+    memory_budget = int(mem_gb * 1024**3) if mem_gb else int(0.8 * available_memory())
+    years = sorted(int(d) for d in os.listdir(inpath) if d.isdigit() and len(d) == 4)
+    catalog = load_catalog(inpath, ndindices)
+    files = {ndindex: [f for f in catalog.files(ndindex) if mosaic_date(f)[0] in years] for ndindex in ndindices}
+    # Workers get the cached profiles, so that they do not open the mosaics just to read them
+    profiles = {ndindex: catalog.profile(files[ndindex][0]) for ndindex in ndindices}
 
-    ix_path = outpath/ndindex
-    base_datapath = ix_path/'base_mosaics'
-    os.makedirs(base_datapath, exist_ok=True)
     dy = 10000
     dx = 9900
-    inputs = [(outpath, years, files, ndindex, x, y, dx, dy) for x, y in 
-               product(range(0, 79200, dx), range(0,120000,dy))]
-
-    with multiprocessing.Pool(8) as pool:
-        pool.starmap(process_patch, inputs)
-
-    
-    interp_folders = [f for f in os.listdir(ix_path) if 'interp_' in f]
-    stats_folders = [f for f in os.listdir(ix_path) if 'stats_' in f]
-    final_interp = ix_path/'interp'
-    os.makedirs(final_interp, exist_ok=True)
-    final_stats = ix_path/'stats'
-    os.makedirs(final_stats, exist_ok=True)
-
-    spring_bases = [base_datapath/f for f in os.listdir(base_datapath) if 'spring' in f]
-    autumn_bases = [base_datapath/f for f in os.listdir(base_datapath) if 'autumn' in f]
-    all_bases = [base_datapath/f for f in os.listdir(base_datapath) if 'all' in f]
-
-    with multiprocessing.Pool(3) as pool:
-        pool.starmap(rio_merge_files, [(spring_bases, ix_path/'base_spring.tif'),
-                                       (autumn_bases, ix_path/'base_autumn.tif'),
-                                       (all_bases, ix_path/'base_all.tif')])
-    
-    rmtree(base_datapath)
-
-    fillyears = [
-        2018,
-        2019,
-        2020,
-        2021,
-        2022
-        ]
-
-    merge_inps = []
-
-    for year in fillyears:
-        os.makedirs(final_interp/str(year), exist_ok=True)
-        os.makedirs(final_stats/str(year), exist_ok=True)
-        merge_inps.extend([([ix_path/fol/str(year)/f for fol in stats_folders], final_stats/str(year)/f) 
-                             for f in os.listdir(ix_path/stats_folders[0]/str(year))])
-        merge_inps.extend([([ix_path/fol/str(year)/f for fol in interp_folders], final_interp/str(year)/f) 
-                             for f in os.listdir(ix_path/interp_folders[0]/str(year))])
-
-    with multiprocessing.Pool(5) as pool:
-        pool.starmap(rio_merge_files, merge_inps)
-    
-    for f in interp_folders: rmtree(ix_path/f)
-
-    for f in stats_folders: rmtree(ix_path/f)
-
-    logging.info('Building overviews')
-    base_fns = [ix_path/'base_spring.tif', ix_path/'base_autumn.tif', ix_path/'base_all.tif'] 
-    stats_fns = [final_stats/year/f for year in os.listdir(final_stats) for f in os.listdir(final_stats/year)]
-    interp_fns = [final_interp/year/f for year in os.listdir(final_interp) for f in os.listdir(final_interp/year)]
-
-    overview_inps = base_fns + stats_fns + interp_fns
-    with multiprocessing.Pool(5) as pool:
-        pool.map(patch_build_overviews, overview_inps)
+    borders = gpd.read_file(f'{get_script_path()}/aux_data/fin_borders.shp')
+    src_prof = profiles[ndindices[0]]
+    tiles = plan_tiles(borders, src_prof['transform'], src_prof['width'], src_prof['height'], dx, dy, outpath/'tile_plan')
+    in_prof = mosaic_profile(src_prof)
+    tiles = [t for t in tiles if t.status != 'outside']
+    logging.info(f'{len(tiles)} tiles within Finnish borders')
+    shards = 0
+    if shard:
+        shard, shards = (int(i) for i in shard.split('/'))
+        tiles = shard_tiles(tiles, shard, shards)
+        logging.info(f'{len(tiles)} tiles in shard {shard}/{shards}')
+
+    products = {}
+    for ndindex in ndindices:
+        prof = in_prof.copy()
+        if ndindex == 'ndbi': prof['nodata'] = 255
+        if prof['nodata'] is None: prof['nodata'] = 0
+        products[ndindex] = national_products(outpath/ndindex, years, files[ndindex], prof)
+    layers = {ndindex: len(files[ndindex]) for ndindex in ndindices}
+    base_layers = {ndindex: len([f for f in files[ndindex] if mosaic_date(f)[1] in (4, 5, 10)])
+                   for ndindex in ndindices}
+
+    manifest = load_manifest(outpath)
+    if spatial_fill and not in_memory: raise ValueError('--spatial_fill requires --in_memory')
+    if backend == 'zarr' and not in_memory: raise ValueError('--backend zarr requires --in_memory')
+    if backend == 'zarr' and timeseries: raise ValueError('--timeseries requires --backend geotiff')
+    # Spatial gap filling changes the filled mosaics and stats, but not the base mosaics
+    fill_params = {'max_distance': MAX_DISTANCE, 'smoothing': SMOOTHING} if spatial_fill else {}
+    # GeoTIFF products are rewritten when their format changes, like the codec of the COGs
+    output_params = {} if backend == 'zarr' else (
+        {'cog': {'codec': codec, 'blocksize': COG_BLOCKSIZE, 'overviews': OVERVIEW_FACTORS}} if in_memory else
+        {'gtiff': {'compress': 'lzw', 'overviews': OVERVIEW_FACTORS}})
+    # A Zarr store is recreated when its layout changes, which invalidates all products in it
+    stores = {ndindex: outpath/ndindex/ZARR_STORE for ndindex in ndindices} if backend == 'zarr' else {}
+    store_params = {ndindex: {'store': store_layout(products[ndindex][outpath/ndindex/'base_all.tif'], years[2:],
+                                                    sorted({mosaic_date(f)[1] for f in files[ndindex]}), dx, dy)}
+                    for ndindex in stores}
+    fingerprints = {ndindex: {fname: fingerprint(inputs, {**(fill_params if fname.parent != outpath/ndindex else {}),
+                                                          **store_params.get(ndindex, {}), **output_params})
+                              for fname, inputs in
+                              product_inputs(outpath/ndindex, years, files[ndindex], ndindex).items()}
+                    for ndindex in ndindices}
+    pending = {ndindex: {fname: fp for fname, fp in fingerprints[ndindex].items()
+                         if not product_done(manifest, outpath, fname, fp, stores.get(ndindex))}
+               for ndindex in ndindices}
+    # The time series is made from the finished monthly mosaics, so it depends on all of their inputs
+    interp_files = {ndindex: [fname for fname in products[ndindex] if fname.parent.parent == outpath/ndindex/'interp']
+                    for ndindex in ndindices}
+    ts_fingerprints = {}
+    if timeseries:
+        for ndindex in ndindices:
+            inputs = {f for fname, inputs in product_inputs(outpath/ndindex, years, files[ndindex], ndindex).items()
+                      if fname in interp_files[ndindex] for f in inputs}
+            fp = fingerprint(inputs, {**fill_params, 'timeseries': {'codec': codec, 'block': TIMESERIES_BLOCK}})
+            if not product_done(manifest, outpath, outpath/ndindex/TIMESERIES, fp):
+                ts_fingerprints[ndindex] = fp
+    logging.info(f'{sum(len(p) for p in pending.values()) + len(ts_fingerprints)} products to update')
+
+    tasks = []
+    if in_memory:
+        # Mosaics that no tile is up to date for are created from scratch, finished ones are reopened
+        tile_products = {t.name: {} for t in tiles}
+        cog_deps = {}
+        reopened = set()
+        for ndindex in ndindices:
+            if ndindex in stores and pending[ndindex]:
+                # Shards share the store, so the first one to get the lock creates it
+                os.makedirs(outpath/ndindex, exist_ok=True)
+                with mosaic_lock(stores[ndindex]):
+                    create_store(stores[ndindex], products[ndindex][outpath/ndindex/'base_all.tif'], years[2:],
+                                 store_params[ndindex]['store']['months'], dx, dy)
+            for fname, fp in pending[ndindex].items():
+                stale = [t for t in tiles if not (stores.get(ndindex, fname).exists() and
+                                                  tile_done(manifest, outpath, t, fname, fp))]
+                cog_deps[fname] = []
+                if ndindex in stores:
+                    # Tiles write their own chunks of the store, so products need no mosaic
+                    for t in stale: tile_products[t.name].setdefault(ndindex, {})[fname] = fp
+                    continue
+                if shards:
+                    # Mosaics are shared by the shards, so the first one to get the lock prepares them
+                    os.makedirs(fname.parent, exist_ok=True)
+                    with mosaic_lock(fname):
+                        if fname.exists(): reopen_mosaic(fname, products[ndindex][fname], OVERVIEW_FACTORS)
+                        create_mosaic(fname, products[ndindex][fname], OVERVIEW_FACTORS)
+                    for t in stale: tile_products[t.name].setdefault(ndindex, {})[fname] = fp
+                    continue
+                if len(stale) == len(tiles) and fname.exists(): os.remove(fname)
+                if fname.exists():
+                    tasks.append(Task(f'reopen_{fname}', reopen_mosaic, (fname, products[ndindex][fname], OVERVIEW_FACTORS),
+                                      memory=GDAL_MEMORY))
+                    cog_deps[fname].append(f'reopen_{fname}')
+                    reopened.add(fname)
+                create_mosaic(fname, products[ndindex][fname], OVERVIEW_FACTORS)
+                for t in stale: tile_products[t.name].setdefault(ndindex, {})[fname] = fp
+        for t in tiles:
+            ix_products = tile_products[t.name]
+            if not ix_products: continue
+            targets = [fname for p in ix_products.values() for fname in p]
+            tasks.append(Task(f'tile_{t.name}', process_tile_batch,
+                              (outpath, years, files, profiles, t, ix_products, spatial_fill, scratch, backend),
+                              memory=max(tile_memory(t, layers[ix], base_layers[ix], True,
+                                                     SPATIAL_HALO if spatial_fill else 0, bool(scratch))
+                                         for ix in ix_products),
+                              cost=t.land * sum(layers[ix] for ix in ix_products),
+                              deps=[f'reopen_{fname}' for fname in targets if fname in reopened]))
+            for fname in targets: cog_deps[fname].append(f'tile_{t.name}')
+        # Shards leave the mosaics writable for the run that finishes them
+        if not shards:
+            tasks.extend(Task(f'cog_{fname}', finish_product, (outpath, fname, fp, build_cog, fname, OVERVIEW_FACTORS, codec),
+                              memory=GDAL_MEMORY, deps=cog_deps[fname])
+                         for ndindex, ix_pending in pending.items() if ndindex not in stores
+                         for fname, fp in ix_pending.items())
+            tasks.extend(Task(f'record_{fname}', record_product, (outpath, fname, fp), deps=cog_deps[fname])
+                         for ndindex in stores for fname, fp in pending[ndindex].items())
+    else:
+        # Per-tile products are removed once all mosaics are finished, so tiles are redone unless they still exist
+        for ndindex in ndindices:
+            if not pending[ndindex]: continue
+            ix_path = outpath/ndindex
+            os.makedirs(ix_path/'base_mosaics', exist_ok=True)
+            tile_tasks = [Task(f'{ndindex}_tile_{t.name}', process_patch_tile,
+                               (outpath, years, files[ndindex], ndindex, t, profiles[ndindex], fingerprints[ndindex],
+                                scratch),
+                               memory=tile_memory(t, layers[ndindex], base_layers[ndindex], False, scratch=bool(scratch)),
+                               cost=t.land * layers[ndindex])
+                          for t in tiles
+                          if not ((ix_path/f'interp_{t.name}').exists() and
+                                  all(tile_done(manifest, outpath, t, fname, fp) for fname, fp in fingerprints[ndindex].items()))]
+            if shards:
+                tasks.extend(tile_tasks)
+                continue
+            merge_tasks = [Task(f'merge_{fname}', merge_product, (ix_path, fname.relative_to(ix_path)),
+                                memory=mosaic_memory(prof['width'], prof['height'], np.dtype(prof['dtype']).itemsize),
+                                deps=[t.name for t in tile_tasks])
+                           for fname, prof in products[ndindex].items() if fname in pending[ndindex]]
+            overview_tasks = [Task(f'overviews_{fname}', finish_product, (outpath, fname, fp, patch_build_overviews, fname),
+                                   memory=GDAL_MEMORY, deps=[f'merge_{fname}'])
+                              for fname, fp in pending[ndindex].items()]
+            tasks.extend(tile_tasks + merge_tasks + overview_tasks)
+            tasks.append(Task(f'{ndindex}_remove_patches', remove_patches, (ix_path,),
+                              deps=[t.name for t in overview_tasks]))
+
+    if not shards:
+        finish = 'cog' if in_memory else 'overviews'
+        tasks.extend(Task(f'timeseries_{ndindex}', finish_product,
+                          (outpath, outpath/ndindex/TIMESERIES, fp, build_timeseries, interp_files[ndindex],
+                           outpath/ndindex/TIMESERIES, codec),
+                          memory=GDAL_MEMORY + timeseries_memory(in_prof['width'], len(interp_files[ndindex])),
+                          deps=[f'{finish}_{fname}' for fname in interp_files[ndindex] if fname in pending[ndindex]])
+                     for ndindex, fp in ts_fingerprints.items())
+
+    if metrics: enable_metrics(metrics)
+    run_tasks(tasks, workers, memory_budget)
+    if shards:
+        # Other shards may still use the locks and the plan
+        logging.info(f'Finished shard {shard}/{shards}')
+        return
+    for lock in outpath.rglob('*.lock'): os.remove(lock)
+    if in_memory:
+        for ovr_path in outpath.rglob('.overviews'): rmtree(ovr_path)
+    rmtree(outpath/'tile_plan')
+    if metrics: summarize_metrics(metrics)
     logging.info('Finished')
\ No newline at end of file
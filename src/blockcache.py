@@ -0,0 +1,232 @@
+import io
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+from rasterio.abc import FileContainer
+
+"""
+Persistent block cache for windowed reads of remote Cloud-Optimized GeoTIFFs. Files are read in
+aligned blocks of `BLOCK_SIZE` bytes, which hold one or a few internal tiles of a COG, and each
+block is saved to the cache directory under the URL of the file, its ETag or modification time
+and the block index, so that runs with other areas or cube sizes reuse the blocks that earlier
+runs downloaded. A read fetches the missing blocks it spans with one HTTP range request per run
+of adjacent blocks, extended by up to `READAHEAD` following missing blocks, as GDAL reads the
+adjacent tiles of a window one by one. The least recently used blocks are evicted when the cache grows over
+its size cap. The cache sits under rasterio as its `opener`, so GDAL reads go through it.
+"""
+
+__all__ = ['BLOCK_SIZE', 'READAHEAD', 'CACHE_GB', 'BlockCache', 'serve_directory']
+
+BLOCK_SIZE = 256 * 1024
+READAHEAD = 4
+CACHE_GB = 20
+
+
+def _request(url:str, method:str='GET', start:int=None, end:int=None) -> tuple[dict, bytes]:
+    "private helper that returns the headers and body of an HTTP request for bytes `start` to `end` of `url`"
+    req = urllib.request.Request(url, method=method)
+    if start is not None: req.add_header('Range', f'bytes={start}-{end-1}')
+    with urllib.request.urlopen(req) as resp:
+        body = resp.read()
+        if start is not None and resp.status != 206:
+            body = body[start:end]
+        return dict(resp.headers), body
+
+
+class _CachedFile(io.RawIOBase):
+    "Read-only file object of remote file `url` of `size` bytes, whose reads are served by `cache`"
+    def __init__(self, cache:'BlockCache', url:str, key:str, size:int):
+        self.cache, self.url, self.key, self.size = cache, url, key, size
+        self.pos = 0
+
+    def readable(self) -> bool: return True
+
+    def seekable(self) -> bool: return True
+
+    def tell(self) -> int: return self.pos
+
+    def seek(self, offset:int, whence:int=io.SEEK_SET) -> int:
+        self.pos = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: self.size}[whence] + offset
+        return self.pos
+
+    def readinto(self, buf) -> int:
+        end = min(self.pos + len(buf), self.size)
+        if end <= self.pos: return 0
+        data = self.cache.read(self.url, self.key, self.pos, end)
+        buf[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
+class BlockCache(FileContainer):
+    """
+    LRU cache of blocks of remote files in directory `path`, holding at most `max_gb` gigabytes.
+    Pass the cache as `opener` to `rasterio.open` or `rioxarray.open_rasterio` to read a URL
+    through it. The cache can be shared by the threads of a process, and processes that share the
+    directory see each other's blocks, although each enforces the size cap on its own view.
+    """
+    def __init__(self, path:Path, max_gb:float=CACHE_GB, block_size:int=BLOCK_SIZE, readahead:int=READAHEAD):
+        self.path, self.max_bytes, self.block_size = Path(path), int(max_gb * 1024**3), block_size
+        self.readahead = readahead
+        os.makedirs(self.path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.heads = {}
+        self.stats = {'hits': 0, 'misses': 0, 'requests': 0}
+        # Blocks from earlier runs, least recently used first
+        blocks = [(f.stat().st_mtime_ns, f.stat().st_size, f) for d in self.path.iterdir() if d.is_dir()
+                  for f in d.iterdir() if f.name.isdigit()]
+        self.blocks = OrderedDict((f, size) for _, size, f in sorted(blocks))
+        self.nbytes = sum(self.blocks.values())
+        with self.lock: self._evict()
+
+    def _head(self, url:str) -> tuple[str, int]:
+        """private helper that returns the cache key and the size of `url`, or None if it does not
+        exist or is not a URL, with one HEAD request per URL"""
+        if not url.startswith(('http://', 'https://')): return None
+        if url not in self.heads:
+            try:
+                headers, _ = _request(url, 'HEAD')
+            except urllib.error.HTTPError as e:
+                if e.code != 404: raise
+                self.heads[url] = None
+            else:
+                version = headers.get('ETag') or headers.get('Last-Modified') or ''
+                key = hashlib.sha1(f'{url} {version}'.encode()).hexdigest()
+                self.heads[url] = key, int(headers['Content-Length'])
+        return self.heads[url]
+
+    def open(self, url:str, mode:str='rb', **kwargs) -> io.BufferedReader:
+        "File object of `url` that reads through the cache"
+        if 'r' not in mode or '+' in mode: raise ValueError(f'Cannot open {url} for writing')
+        if self._head(url) is None: raise FileNotFoundError(url)
+        key, size = self._head(url)
+        return io.BufferedReader(_CachedFile(self, url, key, size), self.block_size)
+
+    def isfile(self, url:str) -> bool: return self._head(url) is not None
+
+    def isdir(self, url:str) -> bool: return False
+
+    def ls(self, url:str) -> list: return []
+
+    def mtime(self, url:str) -> int: return 0
+
+    def size(self, url:str) -> int:
+        if self._head(url) is None: raise FileNotFoundError(url)
+        return self._head(url)[1]
+
+    def rm(self, url:str) -> None: raise OSError(f'Cannot remove {url}')
+
+    def _get(self, fname:Path) -> bytes:
+        "private helper that returns cached block `fname` and marks it used, None if it is not cached"
+        try:
+            with open(fname, 'rb') as f:
+                data = f.read()
+            os.utime(fname)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if fname in self.blocks: self.blocks.move_to_end(fname)
+        return data
+
+    def _put(self, fname:Path, data:bytes) -> None:
+        "private helper that saves block `fname` and evicts the least recently used blocks over the size cap"
+        os.makedirs(fname.parent, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=fname.parent, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, fname)
+        with self.lock:
+            self.nbytes += len(data) - self.blocks.pop(fname, 0)
+            self.blocks[fname] = len(data)
+            self._evict()
+        return
+
+    def _evict(self) -> None:
+        "private helper that removes the least recently used blocks until the cache is within its size cap"
+        while self.nbytes > self.max_bytes and len(self.blocks) > 1:
+            old, size = self.blocks.popitem(last=False)
+            self.nbytes -= size
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                pass
+        return
+
+    def read(self, url:str, key:str, start:int, end:int) -> bytes:
+        """Bytes `start` to `end` of `url` with cache key `key`. Missing blocks are fetched with one
+        range request per run of adjacent missing blocks, the last run extended by `readahead`
+        blocks that are missing too, and saved to the cache"""
+        first, last = start // self.block_size, (end - 1) // self.block_size
+        blocks = {i: self._get(self.path/key/str(i)) for i in range(first, last + 1)}
+        missing = [i for i, data in blocks.items() if data is None]
+        with self.lock:
+            self.stats['hits'] += len(blocks) - len(missing)
+            self.stats['misses'] += len(missing)
+        runs = []
+        for i in missing:
+            if runs and runs[-1][1] == i: runs[-1][1] = i + 1
+            else: runs.append([i, i + 1])
+        size = self.heads[url][1]
+        if runs and runs[-1][1] == last + 1:
+            for i in range(last + 1, min(last + 1 + self.readahead, -(-size // self.block_size))):
+                if (self.path/key/str(i)).exists(): break
+                runs[-1][1] = i + 1
+        for run_start, run_end in runs:
+            _, body = _request(url, start=run_start * self.block_size, end=min(run_end * self.block_size, size))
+            with self.lock: self.stats['requests'] += 1
+            for i in range(run_start, run_end):
+                block = body[(i - run_start) * self.block_size:(i - run_start + 1) * self.block_size]
+                self._put(self.path/key/str(i), block)
+                if i <= last: blocks[i] = block
+        data = b''.join(blocks[i] for i in range(first, last + 1))
+        return data[start - first * self.block_size:end - first * self.block_size]
+
+    def log_stats(self) -> None:
+        "Log the block hits, misses and HTTP requests so far"
+        logging.info('Block cache: {hits} hits, {misses} misses, {requests} range requests'.format(**self.stats))
+        return
+
+
+class _RangeRequestHandler(SimpleHTTPRequestHandler):
+    "Static file handler that serves single range requests, which `SimpleHTTPRequestHandler` does not"
+    def send_head(self):
+        header = self.headers.get('Range', '')
+        fname = self.translate_path(self.path)
+        if not header.startswith('bytes=') or not os.path.isfile(fname):
+            return super().send_head()
+        size = os.path.getsize(fname)
+        start, end = header[6:].split('-')
+        start, end = int(start), min(int(end) + 1 if end else size, size)
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(fname))
+        self.send_header('Content-Range', f'bytes {start}-{end-1}/{size}')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Last-Modified', self.date_time_string(int(os.path.getmtime(fname))))
+        self.end_headers()
+        with open(fname, 'rb') as f:
+            f.seek(start)
+            return io.BytesIO(f.read(end - start))
+
+    def log_message(self, *args): pass
+
+
+@contextmanager
+def serve_directory(path:Path, port:int=0):
+    """Serve the files of `path` over HTTP with range requests on localhost in a background thread,
+    standing in for a STAC or COG host in tests. Yields the base URL of the server"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), partial(_RangeRequestHandler, directory=str(path)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
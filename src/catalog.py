@@ -0,0 +1,121 @@
+import os
+import re
+import json
+import tempfile
+import logging
+import calendar
+import rasterio as rio
+from affine import Affine
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from rasterio.crs import CRS
+from .cube import meta_file
+
+"""
+Catalog of the input mosaics. Mosaics in `<inpath>/<year>/<INDEX>/` are parsed from their
+filenames `pta_sjp_s2ind_<ndindex>_<startdate>_<enddate>.tif` once, and their raster headers
+are cached in `catalog.json` in the input path, so that a run finds the mosaics of an index and
+their profiles without listing folders or opening files. Cached headers are reused as long as the
+size and modification time of the mosaic are unchanged.
+"""
+
+__all__ = ['CATALOG', 'Mosaic', 'Catalog', 'load_catalog']
+
+CATALOG = 'catalog.json'
+
+_MOSAIC_NAME = re.compile(r'pta_sjp_s2ind_(?P<ndindex>[a-z]+)_(?P<start>\d{8})_(?P<end>\d{8})\.tif$')
+
+
+@dataclass
+class Mosaic:
+    "Input mosaic of `ndindex` from `start` to `end` (YYYYMMDD) at `path`, with its cached raster header"
+    ndindex: str
+    start: str
+    end: str
+    path: str
+    meta_path: str
+    size: int
+    mtime_ns: int
+    header: dict
+
+    @property
+    def year(self) -> int: return int(self.start[:4])
+
+    @property
+    def month(self) -> int: return int(self.start[4:6])
+
+    @property
+    def full_month(self) -> bool:
+        "Whether the mosaic covers a whole calendar month"
+        return (self.start[6:] == '01' and self.end[:6] == self.start[:6] and
+                int(self.end[6:]) == calendar.monthrange(self.year, self.month)[1])
+
+    @property
+    def profile(self) -> dict:
+        "Rasterio profile of the mosaic"
+        prof = self.header.copy()
+        prof.update(transform=Affine(*prof['transform']), crs=CRS.from_wkt(prof['crs']) if prof['crs'] else None)
+        return prof
+
+
+def _read_header(fname:Path) -> dict:
+    "private helper that returns the profile of `fname` in a form that can be saved as JSON"
+    with rio.open(fname) as src:
+        header = dict(src.profile)
+    header.update(transform=list(header['transform'])[:6], crs=header['crs'].to_wkt() if header['crs'] else None)
+    return header
+
+
+class Catalog:
+    "Mosaics of a catalog, looked up by index or by path"
+    def __init__(self, mosaics:list[Mosaic]):
+        self.mosaics = sorted(mosaics, key=lambda m: (m.ndindex, m.start, m.end))
+        self._by_date = {(m.ndindex, m.year, m.month): m for m in self.mosaics if m.full_month}
+        self._by_path = {m.path: m for m in self.mosaics}
+
+    def files(self, ndindex:str, months:list=None) -> list[Path]:
+        "Paths of the monthly mosaics of `ndindex`, of `months` only if given, in order of date"
+        return [Path(m.path) for (ix, _, month), m in self._by_date.items()
+                if ix == ndindex and (months is None or month in months)]
+
+    def profile(self, fname:Path) -> dict:
+        "Cached profile of mosaic `fname`"
+        return self._by_path[str(fname)].profile
+
+
+def load_catalog(inpath:Path, ndindices:list) -> Catalog:
+    """
+    Catalog of the mosaics of `ndindices` in `inpath`. Headers are read only for mosaics that are
+    new or changed since `catalog.json` was saved, and the updated catalog is saved back unless
+    `inpath` is read-only
+    """
+    inpath = Path(inpath)
+    cached = {}
+    if (inpath/CATALOG).exists():
+        with open(inpath/CATALOG) as f:
+            cached = {m['path']: Mosaic(**m) for m in json.load(f)}
+    mosaics = []
+    years = [d for d in os.listdir(inpath) if d.isdigit() and len(d) == 4]
+    for ndindex in ndindices:
+        for year in years:
+            if not (inpath/year/ndindex.upper()).is_dir(): continue
+            for name in os.listdir(inpath/year/ndindex.upper()):
+                match = _MOSAIC_NAME.match(name)
+                if not match or match['ndindex'] != ndindex: continue
+                path = str(inpath/year/ndindex.upper()/name)
+                stat = os.stat(path)
+                mosaic = cached.get(path)
+                if mosaic is None or (mosaic.size, mosaic.mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                    mosaic = Mosaic(ndindex, match['start'], match['end'], path,
+                                    meta_file(path) if ndindex == 'ndbi' else None,
+                                    stat.st_size, stat.st_mtime_ns, _read_header(path))
+                cached[path] = mosaic
+                mosaics.append(mosaic)
+    try:
+        # Several runs may load the catalog at once, so each writes its own temporary file
+        with tempfile.NamedTemporaryFile('w', dir=inpath, suffix='.json', delete=False) as f:
+            json.dump([asdict(m) for m in cached.values() if os.path.exists(m.path)], f)
+        os.replace(f.name, inpath/CATALOG)
+    except OSError as e:
+        logging.warning(f'Could not save the catalog to {inpath}: {e}')
+    return Catalog(mosaics)
@@ -0,0 +1,163 @@
+import tempfile
+import numpy as np
+import rasterio as rio
+import rasterio.windows as rio_windows
+from itertools import product
+from pathlib import Path
+from scipy import ndimage
+from .reader import prefetch
+from .numpy_utils import uint8_median
+
+"""
+In-memory counterparts of the gap filling functions in `functions`. A tile is kept as a
+(year, month, y, x) uint8 cube in which gaps hold the nodata value of the mosaics. This is
+how the temporary GeoTIFFs of the file-based chain encode them, so filling the cube gives
+the same results as the read-fill-write round-trips.
+"""
+
+__all__ = ['mosaic_date', 'meta_file', 'has_amplitude', 'read_window', 'scratch_array', 'stage_cube', 'base_median',
+           'fill_prev_years_cube', 'fill_spatial', 'fill_spatial_cube', 'fill_base_cube', 'fill_adjacent_months_cube']
+
+
+def mosaic_date(fname:Path) -> tuple[int, int]:
+    "Year and month of the start date of `pta_sjp_s2ind_<ndindex>_<startdate>_<enddate>.tif`"
+    start = Path(fname).stem.split('_')[-2]
+    return int(start[:4]), int(start[4:6])
+
+def meta_file(fname:Path) -> str:
+    "META mosaic that holds the nodata mask for NDBI mosaic `fname`"
+    return str(fname).replace('ndbi', 'meta').replace('NDBI', 'META')
+
+def has_amplitude(year:int, fill_years:list) -> bool:
+    "Whether `year` gets amplitude, which needs the filled mosaics of the previous year among `fill_years`"
+    return year - 1 in fill_years
+
+def read_window(fname:Path, window:rio_windows.Window, ndindex:str) -> tuple[np.ndarray, np.ndarray, dict]:
+    """Read `window` of `fname` and its nodata mask, which comes from the META mosaic for NDBI.
+    Returns the values, the mask and the profile of `fname`"""
+    with rio.open(fname) as src:
+        prof = src.profile.copy()
+        data = src.read(1, window=window)
+        if ndindex == 'ndbi':
+            with rio.open(meta_file(fname)) as meta:
+                mask = meta.read(1, window=window, masked=True).mask
+        elif src.nodata is not None:
+            mask = data == src.nodata
+        else:
+            mask = np.zeros(data.shape, dtype=bool)
+    return data, mask, prof
+
+def scratch_array(shape:tuple, scratch:Path=None) -> np.ndarray:
+    """Zeroed uint8 array of `shape`, memory-mapped to an unlinked temporary file in directory
+    `scratch` if given, so that the kernel can page it out, and in memory otherwise. The file is
+    removed from disk when the array is garbage collected"""
+    if not scratch: return np.zeros(shape, dtype=np.uint8)
+    with tempfile.TemporaryFile(dir=scratch) as f:
+        return np.memmap(f, dtype=np.uint8, mode='w+', shape=shape)
+
+def stage_cube(files:list, ndindex:str, window:rio_windows.Window, prof:dict,
+               years:list, months:list, scratch:Path=None) -> tuple[np.ndarray, dict]:
+    """
+    Read `window` from all `files` into a (year, month, y, x) cube in which gaps hold the
+    nodata value, which is 255 for NDBI, whose mask comes from the corresponding META mosaic.
+    Missing mosaics are all nodata. The next mosaics are read while the current one is copied
+    to the cube, which is memory-mapped in directory `scratch` if given. `prof` is the profile of
+    the mosaics, for example from the catalog. Returns the cube and the profile for the products
+    of the window.
+    """
+    prof = prof.copy()
+    prof.update(
+        height=window.height,
+        width=window.width,
+        transform=rio_windows.transform(window, prof['transform']),
+        compress='lzw',
+        predictor=2,
+        BIGTIFF='YES'
+    )
+    if ndindex == 'ndbi': prof['nodata'] = 255
+    if prof['nodata'] is None: prof['nodata'] = 0
+    nodata = prof['nodata']
+    cube = scratch_array((len(years), len(months), window.height, window.width), scratch)
+    missing = set(product(range(len(years)), range(len(months))))
+    reads = prefetch(lambda f: read_window(f, window, ndindex), files)
+    for f, (data, mask, _) in zip(files, reads):
+        year, month = mosaic_date(f)
+        data[mask] = nodata
+        cube[years.index(year), months.index(month)] = data
+        missing.discard((years.index(year), months.index(month)))
+    for i, m in missing: cube[i, m] = nodata
+    return cube, prof
+
+def base_median(cube:np.ndarray, nodata:int, month_idx:list, rows:int=256) -> np.ndarray:
+    """Pixelwise median of months `month_idx` from all years of `cube`, ignoring `nodata`. The
+    cube is read in blocks of `rows` rows, so that the months are not copied at once"""
+    base = np.empty(cube.shape[2:], dtype=np.uint8)
+    for r in range(0, base.shape[0], rows):
+        block = cube[:, month_idx, r:r+rows]
+        base[r:r+rows] = uint8_median(block.reshape(-1, *block.shape[2:]), nodata)
+    return base
+
+def fill_prev_years_cube(cube:np.ndarray, nodata:int, fill_idx:list) -> None:
+    """Fill nodata values of years `fill_idx` in place with the maximum value of the same
+    month from two previous years. Going backwards in time keeps the previous years unfilled,
+    as they are in `fill_prev_years`"""
+    for i in sorted(fill_idx, reverse=True):
+        for m in range(cube.shape[1]):
+            maxvals = np.ma.masked_equal(cube[i-2:i, m], nodata).max(axis=0).filled(nodata)
+            cur = cube[i, m]
+            gaps = cur == nodata
+            cur[gaps] = maxvals[gaps]
+    return
+
+def fill_spatial(vals:np.ndarray, nodata:int, max_distance:int=100, smoothing:int=3) -> None:
+    """
+    Fill nodata values of `vals` in place with the nearest valid value within `max_distance`
+    pixels, found with a distance transform, and smooth the filled values with `smoothing`
+    passes of the mean of their valid 3x3 neighbourhood. Gaps are given by `nodata` only, so
+    valid zeros of NDBI are kept. The result depends only on pixels within
+    `max_distance + smoothing`, so windows read with that much halo give seamless results.
+    """
+    gaps = vals == nodata
+    if not gaps.any() or gaps.all(): return
+    dist, (near_rows, near_cols) = ndimage.distance_transform_edt(gaps, return_indices=True)
+    filled = gaps & (dist <= max_distance)
+    vals[filled] = vals[near_rows[filled], near_cols[filled]]
+    del dist, near_rows, near_cols
+    height, width = vals.shape
+    for _ in range(smoothing):
+        valid = vals != nodata
+        padded = np.pad(np.where(valid, vals, 0).astype(np.uint16), 1)
+        padded_valid = np.pad(valid.astype(np.uint8), 1)
+        sums = np.zeros(vals.shape, dtype=np.uint16)
+        counts = np.zeros(vals.shape, dtype=np.uint8)
+        for dr, dc in product(range(3), repeat=2):
+            sums += padded[dr:dr+height, dc:dc+width]
+            counts += padded_valid[dr:dr+height, dc:dc+width]
+        vals[filled] = sums[filled] // counts[filled]
+    return
+
+def fill_spatial_cube(cube:np.ndarray, nodata:int, fill_idx:list, max_distance:int=100, smoothing:int=3) -> None:
+    "Fill all months of years `fill_idx` in place with `fill_spatial`"
+    for i in fill_idx:
+        for m in range(cube.shape[1]):
+            fill_spatial(cube[i, m], nodata, max_distance, smoothing)
+    return
+
+def fill_base_cube(cube:np.ndarray, nodata:int, base:np.ndarray, fill_idx:list, month_idx:list) -> None:
+    "Fill months `month_idx` of years `fill_idx` in place with base mosaic `base`"
+    for i in fill_idx:
+        for m in month_idx:
+            cur = cube[i, m]
+            gaps = cur == nodata
+            cur[gaps] = base[gaps]
+    return
+
+def fill_adjacent_months_cube(cube:np.ndarray, nodata:int, fill_idx:list, m:int) -> None:
+    """Fill month index `m` of years `fill_idx` in place with the mean value of previous
+    and next month of the same year"""
+    for i in fill_idx:
+        cur = cube[i, m]
+        gaps = cur == nodata
+        adjacent = np.ma.masked_equal(cube[i, [m-1, m+1]], nodata)
+        cur[gaps] = adjacent.mean(axis=0).data[gaps]
+    return
@@ -6,13 +6,15 @@ import geopandas as gpd
 import rasterio.mask as rio_mask
 import geopandas as gpd
 from .numpy_utils import * 
+from .reader import prefetch
+from .cube import mosaic_date, has_amplitude
 
 """
 Functions that fill gaps in ndindex mosaics and collate stats from them
 """
 
-__all__ = ['fill_prev_years','fill_base', 'make_amplitude',
-           'fill_adjacent_months', 'make_stats', 'clip_raster']
+__all__ = ['fill_prev_years', 'monthly_files', 'fill_base', 'make_amplitude', 'read_stack', 'YearStacks',
+           'collate_stats', 'write_stats', 'fill_adjacent_months', 'make_stats', 'clip_raster', 'mask_rasters']
 
 
 def fill_prev_years(datapath:Path, outpath:Path, fillyears:list) -> None:
@@ -44,39 +46,45 @@ def fill_prev_years(datapath:Path, outpath:Path, fillyears:list) -> None:
                 dest.write(vals.data, 1)
     return
 
-def fill_base(datapath:Path, base_mosaic:str) -> None:
-    "Fill April, May and October mosaics with basedata mosaic"
-    if 'spring' in str(base_mosaic): base_months = ['04','05']
-    elif 'autumn' in str(base_mosaic): base_months = ['10']
+def monthly_files(files:list, years:list) -> dict:
+    "Filenames of the mosaics `files` of `years` by year and the month of their start date"
+    monthly = {year: {} for year in years}
+    for f in files:
+        year, month = mosaic_date(f)
+        if year in monthly: monthly[year][month] = Path(f).name
+    return monthly
+
+def fill_base(datapath:Path, base_mosaic:str, monthly:dict) -> None:
+    """Fill April, May and October mosaics in `datapath`/<year> with basedata mosaic. `monthly` has
+    the filenames of the mosaics by year and month, from `monthly_files`"""
+    if 'spring' in str(base_mosaic): base_months = [4, 5]
+    elif 'autumn' in str(base_mosaic): base_months = [10]
     else: 
         print('Faulty base mosaic, skipping')
         return
-    for f in os.listdir(datapath):
-        with rio.open(base_mosaic) as wm:
-            wm_vals = wm.read()[0]
-            for mos in [m for m in os.listdir(datapath/f) 
-                        if any(base_month in m for base_month in base_months)
-                        and m.endswith('tif')]:
-                with rio.open(datapath/f/mos) as src:
-                    data = src.read(masked=True)[0]
-                    prof = src.profile
-                data.data[data.mask] = wm_vals[data.mask]
-                with rio.open(datapath/f/mos, 'w', **prof) as dest:
-                    dest.write_band(1, data.data)
+    with rio.open(base_mosaic) as wm:
+        wm_vals = wm.read()[0]
+    for f, names in monthly.items():
+        for mos in [names[m] for m in base_months if m in names]:
+            with rio.open(datapath/str(f)/mos) as src:
+                data = src.read(masked=True)[0]
+                prof = src.profile
+            data.data[data.mask] = wm_vals[data.mask]
+            with rio.open(datapath/str(f)/mos, 'w', **prof) as dest:
+                dest.write_band(1, data.data)
     return
 
-def fill_adjacent_months(datapath:Path, month:int) -> None:
-    """Fill `month` mosaic with the mean value of previous and next month of the same year"""
-    for f in os.listdir(datapath):
-        cur_file = [fname for fname in os.listdir(datapath/str(f)) if f'{month:02d}' in fname and fname.endswith('tif')][0]
+def fill_adjacent_months(datapath:Path, month:int, monthly:dict) -> None:
+    """Fill `month` mosaic in `datapath`/<year> with the mean value of previous and next month of the
+    same year. `monthly` has the filenames of the mosaics by year and month, from `monthly_files`"""
+    for f, names in monthly.items():
+        cur_file = names[month]
         with rio.open(datapath/str(f)/cur_file) as src:
             prof = src.profile
             cur = src.read(masked=True)[0]
-        prev_file = [fname for fname in os.listdir(datapath/str(f)) if f'{month-1:02d}' in fname and fname.endswith('tif')][0]
-        with rio.open(datapath/str(f)/prev_file) as src:
+        with rio.open(datapath/str(f)/names[month-1]) as src:
             prev = src.read(masked=True)[0]
-        nxt_file = [fname for fname in os.listdir(datapath/str(f)) if f'{month+1:02d}' in fname and fname.endswith('tif')][0]
-        with rio.open(datapath/str(f)/nxt_file) as src:
+        with rio.open(datapath/str(f)/names[month+1]) as src:
             nxt = src.read(masked=True)[0]
         cur.data[cur.mask] = np.ma.array([prev, nxt]).mean(axis=0)[cur.mask]
         with rio.open(datapath/str(f)/cur_file, 'w', **prof) as dest:
@@ -93,13 +101,69 @@ def make_amplitude(datapath:Path, yearly_max:np.ndarray, year:int, backtrack:int
         for mos in [datapath/str(y)/m for m in os.listdir(datapath/str(y)) 
                     if m.endswith('tif')]:
             with rio.open(mos) as src:
-                data = src.read(masked=True)[0]
+                data = src.read(1)
+                nodataval = src.nodata
             mosaics.append(data)
-    mosaics = np.ma.array(mosaics)
-    q_25 = nan_percentile(mosaics, 25)[0]
-    return yearly_max.astype(np.int16) - q_25.astype(np.int16)
+    q_25 = uint8_percentile(np.array(mosaics), nodataval, 25)
+    amp = yearly_max.astype(np.int16) - q_25.astype(np.int16)
+    return np.ma.array(amp, mask=np.ma.getmaskarray(yearly_max) | (q_25 == nodataval))
+
+def _read_mosaic(fname:Path) -> tuple[np.ndarray, dict]:
+    "private helper that reads band 1 of `fname` and its profile"
+    with rio.open(fname) as src:
+        return src.read(1), src.profile
+
+def read_stack(datapath:Path) -> tuple[np.ndarray, dict]:
+    """Read all mosaics in `datapath` into a (month, y, x) array, reading the next mosaics while
+    the current one is copied. Returns the array and the profile"""
+    mosaics = []
+    for vals, prof in prefetch(_read_mosaic, [datapath/m for m in os.listdir(datapath) if m.endswith('tif')]):
+        mosaics.append(vals)
+    return np.array(mosaics), prof
+
+class YearStacks:
+    """
+    Cache of the (month, y, x) stacks of the year folders in `datapath`, so that each year is read
+    once however many products need it. `needs` maps each year to be processed to the years whose
+    stacks it uses, and `release` evicts the stacks that no unfinished year needs.
+    """
+    def __init__(self, datapath:Path, needs:dict):
+        self.datapath, self.needs = Path(datapath), needs
+        self.stacks, self.done = {}, set()
+
+    def get(self, year:int) -> tuple[np.ndarray, dict]:
+        "Stack and profile of `year`, read on first use"
+        if year not in self.stacks: self.stacks[year] = read_stack(self.datapath/str(year))
+        return self.stacks[year]
+
+    def release(self, year:int) -> None:
+        "Mark `year` done and evict the stacks that only finished years needed"
+        self.done.add(year)
+        pending = {y for user, ys in self.needs.items() if user not in self.done for y in ys}
+        for y in [y for y in self.stacks if y not in pending]: del self.stacks[y]
+        return
 
-def make_stats(datapath:Path, outpath:Path) -> None:
+def collate_stats(mosaics:np.ndarray, nodata:int, prev_mosaics:np.ndarray=None) -> dict:
+    """
+    Collate yearly stats from a (month, y, x) stack where gaps hold `nodata`. The stats are
+    mean, median, min, max, quantile_10, quantile_25 and sum, and amplitude if the stack of the
+    previous year is given in `prev_mosaics`. All are computed in a single pass with `uint8_stats`
+    """
+    return uint8_stats(mosaics, nodata, prev_mosaics)
+
+def write_stats(outpath:Path, stats:dict, prof:dict, outside:np.ndarray=None) -> None:
+    """Write `stats` to `outpath`/<stat>.tif, with pixels `outside` set to nodata if given. Amplitude
+    and sum are int16 with nodata -999"""
+    os.makedirs(outpath, exist_ok=True)
+    for name, vals in stats.items():
+        stat_prof = prof.copy()
+        if name in ('amp', 'sum'): stat_prof.update({'dtype':'int16', 'nodata': -999})
+        if outside is not None: vals = np.where(outside, stat_prof['nodata'], vals)
+        with rio.open(outpath/f'{name}.tif', 'w', **stat_prof) as dest:
+            dest.write(vals, 1)
+    return
+
+def make_stats(datapath:Path, outpath:Path, outside:np.ndarray=None) -> None:
     """
     Generate yearly stats for the mosaic. The generated stats are
     * Yearly mean, datatype uint8
@@ -108,40 +172,21 @@ def make_stats(datapath:Path, outpath:Path) -> None:
     * Yearly max, datatype uint8
     * Yearly sum, datatype int16
     * Yearly quantiles: 10 and 25 so far, datatype uint8
-    * Amplitude (pixelwise max - yearly_25 quantile), datatype int16
+    * Amplitude (pixelwise max - yearly_25 quantile), datatype int16, for years that follow a year in `datapath`
+
+    Years are processed in order, and each year is read once and kept only until the amplitude
+    of the next year has used it. Pixels `outside` are set to nodata if given.
     """
     os.makedirs(outpath, exist_ok=True)
-    for f in os.listdir(datapath): 
-        os.makedirs(outpath/f, exist_ok=True)
-        mosaics = []
-        for mos in [m for m in os.listdir(datapath/str(f)) if m.endswith('tif')]:
-            with rio.open(datapath/str(f)/mos) as src:
-                prof = src.profile
-                data = src.read(masked=True)[0]
-            mosaics.append(data)
-        mosaics = np.ma.array(mosaics)
-        with rio.open(outpath/str(f)/'mean.tif', 'w', **prof) as dest:
-            dest.write(mosaics.mean(axis=0),1)
-        with rio.open(outpath/str(f)/'median.tif', 'w', **prof) as dest:
-            dest.write(np.ma.median(mosaics, axis=0),1)
-        with rio.open(outpath/str(f)/'min.tif', 'w', **prof) as dest:
-            dest.write(mosaics.min(axis=0),1)
-        with rio.open(outpath/str(f)/'max.tif', 'w', **prof) as dest:
-            dest.write(mosaics.max(axis=0),1)
-        quantiles = nan_percentile(mosaics, [10,25])
-        with rio.open(outpath/str(f)/'quantile_10.tif', 'w', **prof) as dest:
-            dest.write(quantiles[0], 1)
-        with rio.open(outpath/str(f)/'quantile_25.tif', 'w', **prof) as dest:
-            dest.write(quantiles[1], 1)
-        prof.update({'dtype':'int16',
-                     'nodata': -999})
-        del quantiles
-        if int(f) >= 2020: 
-            with rio.open(outpath/str(f)/'amp.tif', 'w', **prof) as dest:
-                dest.write(make_amplitude(datapath, mosaics.max(axis=0), int(f), 2), 1)
-        mosaics = mosaics.astype(np.int16)
-        with rio.open(outpath/str(f)/'sum.tif', 'w', **prof) as dest:
-            dest.write(mosaics.sum(axis=0), 1)
+    years = sorted(int(f) for f in os.listdir(datapath))
+    stacks = YearStacks(datapath, {year: [year, year-1] if has_amplitude(year, years) else [year] for year in years})
+    for year in years:
+        mosaics, prof = stacks.get(year)
+        prev_mosaics = stacks.get(year-1)[0] if has_amplitude(year, years) else None
+        stats = collate_stats(mosaics, prof['nodata'], prev_mosaics)
+        write_stats(outpath/str(year), stats, prof, outside)
+        del mosaics, prev_mosaics, stats
+        stacks.release(year)
     return 
 
 def clip_raster(datapath:Path, borders:gpd.GeoDataFrame) -> None:
@@ -158,6 +203,19 @@ def clip_raster(datapath:Path, borders:gpd.GeoDataFrame) -> None:
         dest.write(out_im)
     return
 
+def mask_rasters(datapath:Path, outside:np.ndarray, monthly:dict) -> None:
+    """Set pixels `outside` to nodata in place in the mosaics in `datapath`/<year>, whose filenames
+    by year and month are in `monthly` from `monthly_files`"""
+    for year, names in monthly.items():
+        for mos in names.values():
+            with rio.open(datapath/str(year)/mos) as src:
+                vals = src.read(1)
+                prof = src.profile
+            vals[outside] = prof['nodata']
+            with rio.open(datapath/str(year)/mos, 'w', **prof) as dest:
+                dest.write(vals, 1)
+    return
+
 def mask_raster(datapath:Path, polys:gpd.GeoDataFrame) -> None:
     with rio.open(datapath) as src:
         out_im, out_transform = rio_mask.mask(src, polys.geometry,
@@ -0,0 +1,67 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from .tiling import Tile
+from .mosaic import mosaic_lock
+
+"""
+Manifest of a run for incremental and resumable processing. For each tile it records the
+fingerprints of the inputs of the products the tile has written, and for each product the
+fingerprint it was finished with. A product whose input fingerprint is unchanged is not
+recomputed, and an interrupted run continues from the tiles that were not yet recorded.
+Fingerprints use the size and modification time of the input mosaics, not their contents.
+"""
+
+__all__ = ['MANIFEST', 'fingerprint', 'load_manifest', 'tile_done', 'product_done', 'record_tile',
+           'record_product']
+
+MANIFEST = 'manifest.json'
+
+
+def fingerprint(files:list, params:dict=None) -> str:
+    "Fingerprint of `files` from their names, sizes and modification times, and of processing `params` if given"
+    stats = sorted({(Path(f).name, os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in files})
+    return hashlib.sha1(json.dumps([stats, params] if params else stats).encode()).hexdigest()
+
+def load_manifest(outpath:Path) -> dict:
+    "Manifest of the run in `outpath`, empty if there is none"
+    if not os.path.exists(Path(outpath)/MANIFEST): return {'tiles': {}, 'products': {}}
+    with open(Path(outpath)/MANIFEST) as f:
+        return json.load(f)
+
+def _key(outpath:Path, fname:Path) -> str:
+    "private helper that returns the manifest key of product `fname`, relative to `outpath`"
+    return str(Path(fname).relative_to(outpath))
+
+def tile_done(manifest:dict, outpath:Path, tile:Tile, fname:Path, fp:str) -> bool:
+    "Whether `tile` has written product `fname` from inputs with fingerprint `fp`"
+    return manifest['tiles'].get(tile.name, {}).get(_key(outpath, fname)) == fp
+
+def product_done(manifest:dict, outpath:Path, fname:Path, fp:str, path:Path=None) -> bool:
+    """Whether product `fname` exists and was finished from inputs with fingerprint `fp`. Products
+    that are stored elsewhere, like in a Zarr store, exist if their `path` does"""
+    return os.path.exists(path or fname) and manifest['products'].get(_key(outpath, fname)) == fp
+
+def _update_manifest(outpath:Path, section:str, values:dict, tile:Tile=None) -> None:
+    """private helper that updates `section` of the manifest in `outpath` with `values`, for `tile`
+    if given. The manifest is shared by the workers, so it is locked and replaced atomically"""
+    fname = Path(outpath)/MANIFEST
+    with mosaic_lock(fname):
+        manifest = load_manifest(outpath)
+        entries = manifest[section] if tile is None else manifest[section].setdefault(tile.name, {})
+        entries.update(values)
+        with open(f'{fname}.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(f'{fname}.tmp', fname)
+    return
+
+def record_tile(outpath:Path, tile:Tile, products:dict) -> None:
+    "Record that `tile` has written `products`, a dict of product and its input fingerprint"
+    _update_manifest(outpath, 'tiles', {_key(outpath, f): fp for f, fp in products.items()}, tile)
+    return
+
+def record_product(outpath:Path, fname:Path, fp:str) -> None:
+    "Record that product `fname` was finished from inputs with fingerprint `fp`"
+    _update_manifest(outpath, 'products', {_key(outpath, fname): fp})
+    return
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import resource
+from pathlib import Path
+
+"""
+Opt-in per-stage metrics of tile processing. Each stage of a tile records its wall time, CPU
+time, bytes read and written and peak memory as a JSON line in the file given to
+`enable_metrics`. The file is passed to worker processes in an environment variable, so that
+workers started by any method write to it. Records are appended, so that runs on several hosts
+that share the output path, like the shards of a run, can write to the same file. Bytes are those passed through read and write calls,
+including reads served from the page cache, and peak memory is reset for each stage where the
+kernel allows it.
+"""
+
+__all__ = ['METRICS_ENV', 'enable_metrics', 'StageMetrics', 'summarize_metrics']
+
+METRICS_ENV = 'NDINDEX_METRICS'
+
+
+def enable_metrics(fname:Path) -> None:
+    """Record stage metrics of this process and the worker processes it starts to JSON lines file
+    `fname`, appending to it if it exists"""
+    open(fname, 'a').close()
+    os.environ[METRICS_ENV] = str(Path(fname).absolute())
+    return
+
+def _io_bytes() -> tuple[int, int]:
+    "private helper that returns the bytes read and written by this process, zeros if they are not available"
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except OSError:
+        return 0, 0
+
+def _reset_peak_rss() -> None:
+    "private helper that resets the peak resident set size of this process on Linux"
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    return
+
+def _peak_rss() -> int:
+    "private helper that returns the peak resident set size of this process in bytes"
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'): return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageMetrics:
+    """
+    Metrics of consecutive stages of processing `tile` for `ndindex`. `start` ends the current
+    stage and starts the next one, `stop` ends the current stage. Nothing is recorded unless
+    metrics are enabled with `enable_metrics`.
+    """
+    def __init__(self, tile:str, ndindex:str=None):
+        self.tile, self.ndindex = tile, ndindex
+        self.fname = os.environ.get(METRICS_ENV)
+        self.stage = None
+
+    def start(self, stage:str) -> None:
+        "End the current stage and start `stage`"
+        self.stop()
+        if not self.fname: return
+        _reset_peak_rss()
+        self.stage = stage
+        self.wall, self.cpu = time.perf_counter(), time.process_time()
+        self.read, self.written = _io_bytes()
+
+    def stop(self) -> None:
+        "End the current stage and write its metrics"
+        if self.stage is None: return
+        read, written = _io_bytes()
+        record = {'tile': self.tile, 'ndindex': self.ndindex, 'stage': self.stage, 'pid': os.getpid(),
+                  'wall_s': round(time.perf_counter() - self.wall, 3),
+                  'cpu_s': round(time.process_time() - self.cpu, 3),
+                  'read_bytes': read - self.read, 'written_bytes': written - self.written,
+                  'peak_rss_bytes': _peak_rss()}
+        with open(self.fname, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(record) + '\n')
+            fcntl.flock(f, fcntl.LOCK_UN)
+        self.stage = None
+
+
+def summarize_metrics(fname:Path, slowest:int=5) -> None:
+    "Log totals per stage of the metrics in `fname` and the `slowest` tiles"
+    with open(fname) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records: return
+    logging.info(f'{"stage":<22}{"count":>6}{"wall s":>10}{"max s":>9}{"cpu s":>10}{"read GB":>9}'
+                 f'{"written GB":>11}{"peak GB":>9}  slowest tile')
+    for stage in dict.fromkeys(r['stage'] for r in records):
+        rs = [r for r in records if r['stage'] == stage]
+        worst = max(rs, key=lambda r: r['wall_s'])
+        logging.info(f'{stage:<22}{len(rs):>6}{sum(r["wall_s"] for r in rs):>10.1f}{worst["wall_s"]:>9.1f}'
+                     f'{sum(r["cpu_s"] for r in rs):>10.1f}{sum(r["read_bytes"] for r in rs)/1024**3:>9.2f}'
+                     f'{sum(r["written_bytes"] for r in rs)/1024**3:>11.2f}'
+                     f'{max(r["peak_rss_bytes"] for r in rs)/1024**3:>9.2f}  {worst["tile"]}')
+    tiles = {}
+    for r in records:
+        key = (r['tile'], r['ndindex'])
+        tiles[key] = tiles.get(key, 0) + r['wall_s']
+    for (tile, ndindex), wall in sorted(tiles.items(), key=lambda t: -t[1])[:slowest]:
+        logging.info(f'Slow tile {tile}{f" ({ndindex})" if ndindex else ""}: {wall:.1f} s')
+    return
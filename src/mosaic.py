@@ -0,0 +1,155 @@
+import os
+import fcntl
+import logging
+import numpy as np
+import rasterio as rio
+import rasterio.shutil as rio_shutil
+import rasterio.windows as rio_windows
+from contextlib import contextmanager
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+"""
+National mosaics that are created up front and written to window by window by the tile workers.
+GeoTIFF does not support concurrent writers, so each write holds an exclusive lock on the file.
+Overview levels are written alongside the full resolution data and the finished mosaics are
+converted to Cloud-Optimized GeoTIFFs that use them, so no overviews need to be computed
+from the full mosaics. Finished mosaics can be reopened for writing, taking the overview levels
+from the COG.
+"""
+
+__all__ = ['OVERVIEW_FACTORS', 'COG_BLOCKSIZE', 'mosaic_profile', 'overview_file', 'create_mosaic', 'reopen_mosaic',
+           'mosaic_lock', 'write_window', 'build_cog']
+
+OVERVIEW_FACTORS = [2**(n+1) for n in range(9)]
+COG_BLOCKSIZE = 512
+
+
+def mosaic_profile(prof:dict) -> dict:
+    "Tiled, compressed BigTIFF profile for a national mosaic based on input profile `prof`"
+    prof = prof.copy()
+    prof.update(
+        tiled=True,
+        blockxsize=512,
+        blockysize=512,
+        compress='lzw',
+        predictor=2,
+        BIGTIFF='YES',
+        sparse_ok=True
+    )
+    return prof
+
+def overview_file(fname:Path, factor:int) -> Path:
+    "Overview level `factor` of mosaic `fname`"
+    return Path(fname).parent/'.overviews'/f'{Path(fname).stem}_{factor}.tif'
+
+def _overview_profile(prof:dict, factor:int) -> dict:
+    "private helper that returns the profile of overview level `factor` of a mosaic with profile `prof`"
+    ovr_prof = prof.copy()
+    ovr_prof.update(
+        width=-(-prof['width'] // factor),
+        height=-(-prof['height'] // factor),
+        transform=prof['transform'] * rio.Affine.scale(factor)
+    )
+    return ovr_prof
+
+def create_mosaic(fname:Path, prof:dict, factors:list=()) -> None:
+    """Create an empty mosaic with profile `prof` and overview levels for `factors`, unless it
+    already exists. Blocks that are never written read as nodata"""
+    if os.path.exists(fname): return
+    os.makedirs(Path(fname).parent, exist_ok=True)
+    for factor in factors:
+        os.makedirs(overview_file(fname, factor).parent, exist_ok=True)
+        with rio.open(overview_file(fname, factor), 'w', **_overview_profile(prof, factor)):
+            pass
+    with rio.open(fname, 'w', **prof):
+        pass
+    return
+
+def _copy_blocks(src:rio.io.DatasetReader, fname:Path, prof:dict) -> None:
+    "private helper that copies `src` to a new raster `fname` with profile `prof` block by block"
+    with rio.open(fname, 'w', **prof) as dest:
+        for _, window in dest.block_windows(1):
+            dest.write(src.read(1, window=window), 1, window=window)
+    return
+
+def reopen_mosaic(fname:Path, prof:dict, factors:list=()) -> None:
+    """Turn the COG `fname` made by `build_cog` back into a mosaic with profile `prof` and overview
+    levels for `factors` that `write_window` can update. The levels are copied from the overviews of
+    the COG. Mosaics without overviews are already writable and are left as they are"""
+    with rio.open(fname) as src:
+        if not src.overviews(1): return
+    logging.info(f'Reopening mosaic {Path(fname).parts[-2]}/{Path(fname).stem}')
+    for i, factor in enumerate(factors):
+        os.makedirs(overview_file(fname, factor).parent, exist_ok=True)
+        with rio.open(fname, overview_level=i) as src:
+            _copy_blocks(src, overview_file(fname, factor), _overview_profile(prof, factor))
+    tmp_file = Path(fname).with_suffix('.tmp.tif')
+    with rio.open(fname) as src:
+        _copy_blocks(src, tmp_file, prof)
+    os.replace(tmp_file, fname)
+    return
+
+def _overview_index(offset:int, size:int, total:int, factor:int) -> tuple[int, np.ndarray]:
+    """private helper that returns the first overview pixel sampled from pixels `offset`..`offset+size`
+    of an axis of length `total`, and the sampled pixels relative to `offset`. Overview pixel `i`
+    is the nearest neighbour of the center of its `factor` pixels"""
+    src = np.minimum(np.arange(-(-total // factor)) * factor + factor // 2, total - 1)
+    sel = np.flatnonzero((src >= offset) & (src < offset + size))
+    if len(sel) == 0: return 0, sel
+    return sel[0], src[sel] - offset
+
+@contextmanager
+def mosaic_lock(fname:Path):
+    "Exclusive lock on mosaic `fname` that works across processes"
+    with open(f'{fname}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def write_window(fname:Path, vals:np.ndarray, window:rio_windows.Window, factors:list=()) -> None:
+    "Write `vals` to `window` of mosaic `fname` and to the corresponding windows of overview levels `factors`"
+    with mosaic_lock(fname):
+        with rio.open(fname, 'r+') as dest:
+            dest.write(vals, 1, window=window)
+            width, height = dest.width, dest.height
+        for factor in factors:
+            col_off, cols = _overview_index(int(window.col_off), vals.shape[1], width, factor)
+            row_off, rows = _overview_index(int(window.row_off), vals.shape[0], height, factor)
+            if len(cols) == 0 or len(rows) == 0: continue
+            with rio.open(overview_file(fname, factor), 'r+') as dest:
+                dest.write(vals[np.ix_(rows, cols)], 1,
+                           window=rio_windows.Window(col_off, row_off, len(cols), len(rows)))
+    return
+
+def _overview_vrt(fname:Path, factors:list) -> str:
+    "private helper that returns a VRT of mosaic `fname` that declares its overview levels"
+    with rio.open(fname) as src:
+        prof = src.profile
+    gdal_types = {'uint8': 'Byte', 'int16': 'Int16', 'uint16': 'UInt16'}
+    overviews = ''.join(f'<Overview><SourceFilename relativeToVRT="0">{escape(str(overview_file(fname, factor).absolute()))}'
+                        '</SourceFilename><SourceBand>1</SourceBand></Overview>' for factor in factors)
+    return (f'<VRTDataset rasterXSize="{prof["width"]}" rasterYSize="{prof["height"]}">'
+            f'<SRS>{escape(prof["crs"].to_wkt())}</SRS>'
+            f'<GeoTransform>{", ".join(str(v) for v in prof["transform"].to_gdal())}</GeoTransform>'
+            f'<VRTRasterBand dataType="{gdal_types[prof["dtype"]]}" band="1">'
+            f'<NoDataValue>{prof["nodata"]}</NoDataValue>'
+            f'<SimpleSource><SourceFilename relativeToVRT="0">{escape(str(Path(fname).absolute()))}</SourceFilename>'
+            f'<SourceBand>1</SourceBand></SimpleSource>{overviews}</VRTRasterBand></VRTDataset>')
+
+def build_cog(fname:Path, factors:list, codec:str='deflate') -> None:
+    """Replace mosaic `fname` with a Cloud-Optimized GeoTIFF compressed with `codec`, using the
+    overview levels written with `write_window` instead of computing them"""
+    logging.info(f'Creating COG {Path(fname).parts[-2]}/{Path(fname).stem}')
+    vrt_file = Path(fname).with_suffix('.vrt')
+    cog_file = Path(fname).with_suffix('.cog.tif')
+    with open(vrt_file, 'w') as vrt:
+        vrt.write(_overview_vrt(fname, factors))
+    rio_shutil.copy(vrt_file, cog_file, driver='COG', compress=codec, predictor='YES',
+                    overviews='FORCE_USE_EXISTING', blocksize=COG_BLOCKSIZE, bigtiff='YES')
+    os.replace(cog_file, fname)
+    os.remove(vrt_file)
+    for factor in factors: os.remove(overview_file(fname, factor))
+    return
@@ -2,7 +2,7 @@ import numpy as np
 
 "Faster way to use np.nanpercentile, from https://krstn.eu/np.nanpercentile()-there-has-to-be-a-faster-way/"
 
-__all__ = ['nan_percentile']
+__all__ = ['nan_percentile', 'uint8_stats', 'uint8_percentile', 'uint8_median']
 
 def _zvalue_from_index(arr:np.ndarray, ind:np.ndarray) -> np.ndarray:
     """private helper function to work around the limitation of np.choose() by employing np.take()
@@ -56,4 +56,105 @@ def nan_percentile(arr:np.ndarray, q:int|list[int]) -> list[np.ndarray]:
 
         result.append(quant_arr)
 
-    return result
\ No newline at end of file
+    return result
+
+def _keys(arr:np.ndarray, nodata:int) -> np.ndarray:
+    """private helper that shifts uint8 values so that nodata (0 or 255) maps to 255 and the
+    valid values keep their order in 0..254"""
+    if nodata not in (0, 255): raise ValueError(f'Unsupported nodata value {nodata}, must be 0 or 255')
+    return arr - np.uint8((nodata + 1) % 256)
+
+def _select(keys:np.ndarray, rank:np.ndarray) -> np.ndarray:
+    """private helper that returns the `rank`th smallest valid key along the first axis by
+    building the result bit by bit from the number of keys below each candidate. Invalid
+    keys (255) are never below a candidate, so they need no masking"""
+    val = np.zeros(keys.shape[1:], dtype=np.uint8)
+    below = np.empty(keys.shape[1:], dtype=np.uint8)
+    for bit in (128, 64, 32, 16, 8, 4, 2, 1):
+        cand = val | np.uint8(bit)
+        below[:] = 0
+        for layer in keys: np.add(below, layer < cand, out=below)
+        val = np.where(below <= rank, cand, val)
+    return val
+
+def _percentile(keys:np.ndarray, valid_obs:np.ndarray, q:int, off:np.uint8) -> np.ndarray:
+    """private helper that computes the same linear interpolation as `nan_percentile` from
+    the selected values, truncated to uint8"""
+    k_arr = (valid_obs.astype(np.int64) - 1) * (q / 100.0)
+    f_arr = np.floor(k_arr).astype(np.int32)
+    c_arr = np.ceil(k_arr).astype(np.int32)
+    rank_f = np.maximum(f_arr, 0).astype(np.uint8)
+    rank_c = np.maximum(c_arr, 0).astype(np.uint8)
+    floor_val = _select(keys, rank_f) + off
+    ceil_val = _select(keys, rank_c) + off
+    quant_arr = floor_val * (c_arr - k_arr) + ceil_val * (k_arr - f_arr)
+    fc_equal_k_mask = f_arr == c_arr
+    quant_arr[fc_equal_k_mask] = floor_val[fc_equal_k_mask]
+    return quant_arr.astype(np.uint8)
+
+def uint8_stats(stack:np.ndarray, nodata:int, prev:np.ndarray=None, rows:int=256) -> dict:
+    """
+    Yearly stats of a (layer, y, x) uint8 `stack` where gaps hold `nodata` (0 or 255), computed
+    in a single pass over blocks of `rows` rows. Medians and quantiles are selected by counting
+    instead of sorting, and the results are the same as from `np.ma` functions and `nan_percentile`
+    for masked arrays: mean, median, min, max, quantile_10 and quantile_25 are uint8 with
+    `nodata`, sum is int16 with -999. If the stack of the previous year is given as `prev`,
+    amplitude (max - 25-quantile of both years) is added as int16 with -999.
+    """
+    off = np.uint8((nodata + 1) % 256)
+    shape = stack.shape[1:]
+    stats = {name: np.empty(shape, dtype=np.uint8) for name in
+             ('mean', 'median', 'min', 'max', 'quantile_10', 'quantile_25')}
+    stats['sum'] = np.empty(shape, dtype=np.int16)
+    if prev is not None: stats['amp'] = np.empty(shape, dtype=np.int16)
+    for r in range(0, shape[0], rows):
+        keys = _keys(stack[:, r:r+rows], nodata)
+        valid_obs = np.zeros(keys.shape[1:], dtype=np.uint8)
+        max_key = np.zeros(keys.shape[1:], dtype=np.uint8)
+        key_sum = np.zeros(keys.shape[1:], dtype=np.int32)
+        for layer in keys:
+            np.add(valid_obs, layer != 255, out=valid_obs)
+            np.maximum(max_key, layer + np.uint8(1), out=max_key)
+            np.add(key_sum, layer, out=key_sum)
+        nodata_mask = valid_obs == 0
+        valid_sum = key_sum - 255 * (len(keys) - valid_obs.astype(np.int32)) + off * valid_obs.astype(np.int32)
+        block = {'mean': valid_sum // np.maximum(valid_obs, 1),
+                 'median': (_select(keys, (valid_obs - 1) // 2).astype(np.uint16)
+                            + _select(keys, valid_obs // 2) + 2 * off) // 2,
+                 'min': keys.min(axis=0) + off,
+                 'max': max_key - np.uint8(1) + off,
+                 'quantile_10': _percentile(keys, valid_obs, 10, off),
+                 'quantile_25': _percentile(keys, valid_obs, 25, off),
+                 'sum': valid_sum}
+        if prev is not None:
+            prev_keys = _keys(prev[:, r:r+rows], nodata)
+            valid_all = valid_obs + (prev_keys != 255).sum(axis=0, dtype=np.uint8)
+            q_25 = _percentile(np.concatenate([keys, prev_keys]), valid_all, 25, off)
+            block['amp'] = block['max'].astype(np.int16) - q_25.astype(np.int16)
+        for name, vals in block.items():
+            stats[name][r:r+rows] = np.where(nodata_mask, -999 if name in ('sum', 'amp') else nodata, vals)
+    return stats
+
+def uint8_percentile(stack:np.ndarray, nodata:int, q:int, rows:int=256) -> np.ndarray:
+    """`q`th percentile of a (layer, y, x) uint8 `stack` where gaps hold `nodata`, as computed
+    by `nan_percentile` for a masked stack and truncated to uint8. All-nodata pixels get `nodata`"""
+    off = np.uint8((nodata + 1) % 256)
+    result = np.empty(stack.shape[1:], dtype=np.uint8)
+    for r in range(0, result.shape[0], rows):
+        keys = _keys(stack[:, r:r+rows], nodata)
+        valid_obs = (keys != 255).sum(axis=0, dtype=np.uint8)
+        result[r:r+rows] = np.where(valid_obs == 0, nodata, _percentile(keys, valid_obs, q, off))
+    return result
+
+def uint8_median(stack:np.ndarray, nodata:int, rows:int=256) -> np.ndarray:
+    """Median of a (layer, y, x) uint8 `stack` where gaps hold `nodata`, as computed by `np.ma.median`
+    for a masked stack into a uint8 array. All-nodata pixels get 0 like there. The stack is read
+    in blocks of `rows` rows, so it can be memory-mapped"""
+    off = np.uint8((nodata + 1) % 256)
+    result = np.empty(stack.shape[1:], dtype=np.uint8)
+    for r in range(0, result.shape[0], rows):
+        keys = _keys(stack[:, r:r+rows], nodata)
+        valid_obs = (keys != 255).sum(axis=0, dtype=np.uint8)
+        median = (_select(keys, (valid_obs - 1) // 2).astype(np.uint16) + _select(keys, valid_obs // 2) + 2 * off) // 2
+        result[r:r+rows] = np.where(valid_obs == 0, 0, median)
+    return result
@@ -0,0 +1,29 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+
+"""
+Prefetching of mosaic reads. GDAL releases the GIL while it reads and decodes, so reading the
+next windows in background threads overlaps I/O with the computation on the current ones. The
+number of reads in flight is bounded, so that at most `depth` windows wait in memory besides
+the one being processed.
+"""
+
+__all__ = ['PREFETCH_THREADS', 'PREFETCH_DEPTH', 'prefetch']
+
+PREFETCH_THREADS = 4
+PREFETCH_DEPTH = 4
+
+
+def prefetch(func:Callable, items:Iterable, threads:int=PREFETCH_THREADS, depth:int=PREFETCH_DEPTH) -> Iterator:
+    """Yield `func(item)` for `items` in order, while calling `func` for up to `depth` next items
+    in `threads` background threads. `func` should open its own datasets, as they are not thread-safe"""
+    items = iter(items)
+    with ThreadPoolExecutor(threads) as executor:
+        queue = deque(executor.submit(func, item) for item in islice(items, depth))
+        while queue:
+            result = queue.popleft().result()
+            queue.extend(executor.submit(func, item) for item in islice(items, 1))
+            yield result
+    return
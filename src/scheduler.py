@@ -0,0 +1,85 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Callable
+from .tiling import Tile
+from .reader import PREFETCH_DEPTH
+
+"""
+Scheduling of tile processing and the work that follows it. Tasks are admitted against a memory
+budget and a number of workers instead of a fixed pool size, the most expensive ready tasks first,
+and tasks that depend on others start as soon as their dependencies are done.
+"""
+
+__all__ = ['GDAL_MEMORY', 'Task', 'available_memory', 'tile_memory', 'mosaic_memory', 'run_tasks']
+
+# Rough memory used by GDAL when copying or building overviews for a mosaic, in bytes
+GDAL_MEMORY = 1024**3
+
+
+@dataclass
+class Task:
+    "Call `func(*args)` once all tasks named in `deps` are done"
+    name: str
+    func: Callable
+    args: tuple
+    memory: int = 0
+    cost: float = 0.
+    deps: list = field(default_factory=list)
+
+
+def available_memory() -> int:
+    "Physical memory of the machine in bytes"
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def tile_memory(tile:Tile, layers:int, base_layers:int, in_memory:bool, halo:int=0, scratch:bool=False) -> int:
+    """
+    Estimate of the peak memory for processing `tile` with `layers` input mosaics, of which
+    `base_layers` are used for the base mosaics. Full windows are read regardless of land
+    fraction, so memory depends on the layers only, while land fraction sets the compute cost.
+    In memory, the uint8 cube dominates, and with temporary files the stack of windows for the
+    base mosaics. With `scratch`, these are memory-mapped and left out, so that the per-month
+    temporaries of the filling and stats remain. With a `halo` for spatial gap filling, the
+    window is larger and the distance transform of a month adds its distances and nearest pixel
+    indices. Both add the windows and masks that are prefetched.
+    """
+    pixels = (tile.dx + 2*halo) * (tile.dy + 2*halo)
+    prefetched = 2 * (PREFETCH_DEPTH + 1)
+    stack = 0 if scratch else layers if in_memory else base_layers
+    return pixels * (stack + 16 + (24 if halo else 0) + prefetched)
+
+def mosaic_memory(width:int, height:int, itemsize:int) -> int:
+    "Estimate of the memory for merging a `width`x`height` mosaic, which is read fully into memory"
+    return width * height * itemsize + GDAL_MEMORY
+
+def run_tasks(tasks:list[Task], workers:int, memory_budget:int) -> None:
+    """
+    Run `tasks` in `workers` processes. A ready task is started only if its memory fits in
+    `memory_budget` together with the running ones, except when nothing is running. Ready tasks
+    are started in order of decreasing cost, so that smaller ones fill the remaining budget.
+    """
+    pending = {t.name: t for t in tasks}
+    done = set()
+    running = {}
+    used = 0
+    with ProcessPoolExecutor(workers) as executor:
+        while pending or running:
+            ready = sorted([t for t in pending.values() if all(d in done for d in t.deps)],
+                           key=lambda t: (t.cost, t.memory), reverse=True)
+            for t in ready:
+                if len(running) >= workers: break
+                if running and used + t.memory > memory_budget: continue
+                running[executor.submit(t.func, *t.args)] = t
+                used += t.memory
+                del pending[t.name]
+            if not running:
+                raise ValueError(f'Unmet dependencies for tasks {list(pending)}')
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                t = running.pop(future)
+                used -= t.memory
+                future.result()
+                done.add(t.name)
+            logging.info(f'{len(done)}/{len(tasks)} tasks done, {used/1024**3:.1f} GB in use')
+    return
@@ -0,0 +1,218 @@
+import os
+import numpy as np
+import xarray as xr
+import dask.array as da
+import pystac
+import pystac_client
+import rioxarray
+import rasterio.warp as rio_warp
+import rasterio.windows as rio_windows
+from datetime import datetime, timezone
+from pathlib import Path
+from shapely.geometry import box, mapping
+from .blockcache import BlockCache
+from .catalog import Catalog
+from .cube import has_amplitude, base_median, fill_prev_years_cube, fill_base_cube, fill_adjacent_months_cube
+from .mosaic import OVERVIEW_FACTORS, mosaic_profile, create_mosaic, write_window, build_cog
+from .numpy_utils import uint8_stats
+
+"""
+Lazy xarray/dask version of the gap filling chain for mosaics from a STAC catalog, the workflow
+of `processing_flow_stac.ipynb`. The items are opened as a (year, month, y, x) uint8 cube in
+which gaps hold the nodata value, chunked in space only, and each chunk is filled with the
+functions of `cube`, so the filled cube is evaluated once per chunk. All stats come from one
+`uint8_stats` pass over the filled chunk, and all products are streamed chunk by chunk to
+national mosaics from a single dask graph. The results are the same as from `process_tile`.
+"""
+
+__all__ = ['SEASONS', 'STAC_STATS', 'make_stac_catalog', 'stac_items', 'stac_cube', 'fill_stac_cube', 'stac_stats',
+           'write_stac_products']
+
+SEASONS = ['spring', 'autumn', 'all']
+STAC_STATS = ['mean', 'median', 'min', 'max', 'quantile_10', 'quantile_25', 'sum', 'amp']
+
+
+def make_stac_catalog(catalog:Catalog, fname:Path, collection:str='s2ind', base_url:str=None, root:Path=None) -> None:
+    """Save the monthly mosaics of `catalog` as a file-based STAC catalog `fname` with one item per
+    month, that has the mosaics of each index as assets named by the index and the META mosaics
+    of NDBI as `meta`. Used to run the STAC workflow on local mosaics. If `base_url` is given, the
+    assets link to the mosaics under that URL by their paths relative to `root`, for serving
+    them over HTTP with `serve_directory`"""
+    def href(path):
+        if base_url: return f'{base_url.rstrip("/")}/{Path(path).absolute().relative_to(Path(root).absolute()).as_posix()}'
+        return str(Path(path).absolute())
+    stac = pystac.Catalog(collection, 'Monthly S2ind mosaics')
+    items = {}
+    for m in catalog.mosaics:
+        if not m.full_month: continue
+        if (m.year, m.month) not in items:
+            prof = m.profile
+            bounds = rio_warp.transform_bounds(prof['crs'], 'EPSG:4326',
+                                               *rio_windows.bounds(rio_windows.Window(0, 0, prof['width'], prof['height']),
+                                                                   prof['transform']))
+            items[m.year, m.month] = pystac.Item(
+                f'{collection}_{m.start}_{m.end}', mapping(box(*bounds)), list(bounds), None, {},
+                start_datetime=datetime.strptime(m.start, '%Y%m%d').replace(tzinfo=timezone.utc),
+                end_datetime=datetime.strptime(m.end, '%Y%m%d').replace(tzinfo=timezone.utc), collection=collection)
+        items[m.year, m.month].add_asset(m.ndindex, pystac.Asset(href(m.path), media_type=pystac.MediaType.GEOTIFF))
+        if m.meta_path:
+            items[m.year, m.month].add_asset('meta', pystac.Asset(href(m.meta_path),
+                                                                  media_type=pystac.MediaType.GEOTIFF))
+    stac.add_items(items.values())
+    stac.normalize_and_save(str(Path(fname).parent), pystac.CatalogType.ABSOLUTE_PUBLISHED)
+    return
+
+def _item_dates(item:pystac.Item) -> tuple[datetime, datetime]:
+    "private helper that returns the start and end date of `item`"
+    start = item.common_metadata.start_datetime or item.datetime
+    return start, item.common_metadata.end_datetime or start
+
+def stac_items(catalog:str, collection:str=None, start:str=None, end:str=None) -> list[pystac.Item]:
+    """Items of `collection` that start and end between dates `start` and `end` (YYYY-MM-DD), from the
+    STAC API at URL `catalog` or from a file-based STAC catalog"""
+    if str(catalog).startswith(('http://', 'https://')):
+        search = pystac_client.Client.open(catalog).search(collections=[collection] if collection else None,
+                                                           datetime=f'{start or ".."}/{end or ".."}')
+        return list(search.items())
+    items = []
+    for item in pystac.Catalog.from_file(str(catalog)).get_items(recursive=True):
+        item_start, item_end = (d.date().isoformat() for d in _item_dates(item))
+        if collection and item.collection_id != collection: continue
+        if (start and item_start < start) or (end and item_end > end): continue
+        items.append(item)
+    return items
+
+def _open_asset(asset:pystac.Asset, bounds:tuple, chunks:int, cache:BlockCache=None) -> xr.DataArray:
+    "private helper that opens band 1 of `asset` lazily, clipped to `bounds` if given, reading URLs through `cache`"
+    href = asset.get_absolute_href()
+    opener = cache if cache and href.startswith(('http://', 'https://')) else None
+    layer = rioxarray.open_rasterio(href, chunks={'x': chunks, 'y': chunks}, opener=opener).squeeze('band', drop=True)
+    return layer.rio.clip_box(*bounds) if bounds else layer
+
+def _gaps(layer:xr.DataArray) -> xr.DataArray:
+    "private helper that returns where `layer` equals its nodata value"
+    return layer == layer.rio.nodata if layer.rio.nodata is not None else xr.zeros_like(layer, dtype=bool)
+
+def stac_cube(items:list, ndindex:str, bounds:tuple=None, chunks:int=1024, cache:BlockCache=None) -> xr.DataArray:
+    """
+    Lazy (year, month, y, x) uint8 cube of the monthly `ndindex` mosaics in `items`, clipped to
+    `bounds` in the CRS of the mosaics if given, and in `chunks`x`chunks` pixel chunks that hold all
+    years and months. Gaps hold the nodata value, which is 255 for NDBI, whose gaps come from the
+    `meta` assets. Months without a mosaic are all nodata, and the `mosaic` coordinate has the
+    file names of the mosaics and '' for those. Remote mosaics are read through block cache
+    `cache` if given.
+    """
+    monthly = {}
+    for item in items:
+        start, end = _item_dates(item)
+        if start.day == 1 and (end.year, end.month) == (start.year, start.month) and ndindex in item.assets:
+            monthly[start.year, start.month] = item
+    years = list(range(min(y for y, _ in monthly), max(y for y, _ in monthly) + 1))
+    months = sorted({m for _, m in monthly})
+    layers, nodata = {}, None
+    for key, item in monthly.items():
+        layer = _open_asset(item.assets[ndindex], bounds, chunks, cache)
+        if nodata is None: nodata, crs = 255 if ndindex == 'ndbi' else int(layer.rio.nodata or 0), layer.rio.crs
+        gaps = _gaps(_open_asset(item.assets['meta'], bounds, chunks, cache)) if ndindex == 'ndbi' else _gaps(layer)
+        layers[key] = xr.where(gaps, np.uint8(nodata), layer)
+    blank = xr.full_like(next(iter(layers.values())), nodata)
+    cube = xr.concat([xr.concat([layers.get((y, m), blank) for m in months], dim='month') for y in years], dim='year')
+    names = [[Path(monthly[y, m].assets[ndindex].href).name if (y, m) in monthly else '' for m in months] for y in years]
+    cube = cube.chunk({'year': -1, 'month': -1, 'y': chunks, 'x': chunks})
+    cube = cube.assign_coords(year=years, month=months, mosaic=(('year', 'month'), names))
+    return cube.rio.write_crs(crs).rio.write_nodata(nodata)
+
+def _base_block(block:np.ndarray, nodata:int, months:list) -> np.ndarray:
+    "private helper that returns the spring, autumn and all base mosaics of a chunk of the cube"
+    spring_idx, autumn_idx = [months.index(m) for m in (4, 5)], [months.index(10)]
+    return np.array([base_median(block, nodata, spring_idx), base_median(block, nodata, autumn_idx),
+                     base_median(block, nodata, spring_idx + autumn_idx)])
+
+def _fill_block(block:np.ndarray, bases:np.ndarray, nodata:int, months:list) -> np.ndarray:
+    "private helper that fills all years but the first two of a chunk of the cube like `process_tile`"
+    cube = block.copy()
+    fill_idx = list(range(2, len(cube)))
+    fill_prev_years_cube(cube, nodata, fill_idx)
+    fill_base_cube(cube, nodata, bases[0], fill_idx, [months.index(m) for m in (4, 5)])
+    fill_base_cube(cube, nodata, bases[1], fill_idx, [months.index(10)])
+    for m in range(5, 10):
+        fill_adjacent_months_cube(cube, nodata, fill_idx, months.index(m))
+    return cube
+
+def fill_stac_cube(cube:xr.DataArray) -> tuple[xr.DataArray, xr.DataArray]:
+    """Lazily fill `cube` from `stac_cube`. Returns the (season, y, x) base mosaics and the filled
+    cube, in which the first two years are left as they are, because they have no previous years
+    to fill from"""
+    nodata, months = int(cube.rio.nodata), [int(m) for m in cube.month]
+    bases = da.blockwise(_base_block, 'sij', cube.data, 'ymij', new_axes={'s': len(SEASONS)}, concatenate=True,
+                         nodata=nodata, months=months, meta=np.empty((0, 0, 0), dtype=np.uint8))
+    filled = da.blockwise(_fill_block, 'ymij', cube.data, 'ymij', bases, 'sij', concatenate=True,
+                          nodata=nodata, months=months, meta=np.empty((0, 0, 0, 0), dtype=np.uint8))
+    bases = xr.DataArray(bases, dims=('season', 'y', 'x'),
+                         coords={'season': SEASONS, 'y': cube.y, 'x': cube.x, 'spatial_ref': cube.spatial_ref})
+    return bases.rio.write_nodata(nodata), cube.copy(data=filled)
+
+def _stats_block(block:np.ndarray, nodata:int, years:list) -> np.ndarray:
+    """private helper that returns the `STAC_STATS` of the filled years of a chunk of the filled cube
+    as int16, with -999 for the amplitude of the first filled year"""
+    out = np.full((len(years) - 2, len(STAC_STATS), *block.shape[2:]), -999, dtype=np.int16)
+    for i in range(2, len(years)):
+        stats = uint8_stats(block[i], nodata, block[i-1] if has_amplitude(years[i], years[2:]) else None)
+        for j, name in enumerate(STAC_STATS):
+            if name in stats: out[i-2, j] = stats[name]
+    return out
+
+def stac_stats(filled:xr.DataArray) -> xr.DataArray:
+    """Lazy (year, stat, y, x) `STAC_STATS` of the filled years of `filled` from `fill_stac_cube`,
+    computed together in one pass over each chunk. Stats are int16 here, and amplitude and sum
+    have nodata -999 while the others fit uint8 with the nodata of the mosaics"""
+    years = [int(y) for y in filled.year]
+    stats = da.blockwise(_stats_block, 'ysij', filled.data, 'ymij', new_axes={'s': len(STAC_STATS)},
+                         adjust_chunks={'y': len(years) - 2}, concatenate=True,
+                         nodata=int(filled.rio.nodata), years=years, meta=np.empty((0, 0, 0, 0), dtype=np.int16))
+    return xr.DataArray(stats, dims=('year', 'stat', 'y', 'x'),
+                        coords={'year': years[2:], 'stat': STAC_STATS, 'y': filled.y, 'x': filled.x,
+                                'spatial_ref': filled.spatial_ref})
+
+
+class _MosaicTarget:
+    "Target of `dask.array.store` that writes the stored chunks to mosaic `fname` with `write_window`"
+    def __init__(self, fname:Path, factors:list):
+        self.fname, self.factors = fname, factors
+
+    def __setitem__(self, key:tuple, vals:np.ndarray):
+        write_window(self.fname, vals, rio_windows.Window.from_slices(*key), self.factors)
+
+
+def write_stac_products(ix_path:Path, cube:xr.DataArray, codec:str='deflate') -> None:
+    """
+    Fill `cube` from `stac_cube` and write the base mosaics, the filled monthly mosaics and the
+    yearly stats to `ix_path` as Cloud-Optimized GeoTIFFs compressed with `codec`, laid out like the
+    products of `process_files.py`. All products are computed from one dask graph and written chunk
+    by chunk, so each chunk is read and filled once and no product is held in memory whole.
+    """
+    ix_path = Path(ix_path)
+    bases, filled = fill_stac_cube(cube)
+    stats = stac_stats(filled)
+    nodata = int(cube.rio.nodata)
+    prof = mosaic_profile({'driver': 'GTiff', 'dtype': 'uint8', 'nodata': nodata, 'count': 1,
+                           'width': cube.sizes['x'], 'height': cube.sizes['y'],
+                           'crs': cube.rio.crs, 'transform': cube.rio.transform()})
+    stat_prof = prof.copy()
+    stat_prof.update({'dtype': 'int16', 'nodata': -999})
+    products = {ix_path/f'base_{season}.tif': (bases.data[i], prof) for i, season in enumerate(SEASONS)}
+    for i, year in enumerate(filled.year.values[2:], 2):
+        for j, name in enumerate(filled.mosaic.values[i]):
+            if name: products[ix_path/'interp'/str(year)/name] = (filled.data[i, j], prof)
+    for i, year in enumerate(stats.year.values):
+        for j, name in enumerate(STAC_STATS):
+            if name == 'amp' and not has_amplitude(year, list(stats.year.values)): continue
+            products[ix_path/'stats'/str(year)/f'{name}.tif'] = ((stats.data[i, j], stat_prof) if name in ('amp', 'sum')
+                                                                 else (stats.data[i, j].astype(np.uint8), prof))
+    for fname, (_, fprof) in products.items():
+        if fname.exists(): os.remove(fname)
+        create_mosaic(fname, fprof, OVERVIEW_FACTORS)
+    da.store([vals for vals, _ in products.values()], [_MosaicTarget(fname, OVERVIEW_FACTORS) for fname in products],
+             lock=False)
+    for fname in products: build_cog(fname, OVERVIEW_FACTORS, codec)
+    return
@@ -0,0 +1,71 @@
+import os
+import calendar
+import numpy as np
+import rasterio as rio
+from affine import Affine
+from pathlib import Path
+from rasterio.transform import from_origin
+from scipy import ndimage
+from .cube import meta_file
+
+"""
+Synthetic S2ind-like mosaics for benchmarking. Mosaics follow the folder and filename pattern
+`<inpath>/<year>/<INDEX>/pta_sjp_s2ind_<ndindex>_<startdate>_<enddate>.tif` of the real data,
+with a seasonal signal over a smooth landscape, cloud-shaped gaps and missing swaths. For NDBI,
+gaps hold 0 like valid values do, and the nodata mask is in the corresponding META mosaics.
+"""
+
+__all__ = ['SYNTHETIC_TRANSFORM', 'MONTHS', 'synthetic_mosaics']
+
+# 10 m pixels with the upper left corner in Pirkanmaa, so that windows of up to 10000 pixels are within Finland
+SYNTHETIC_TRANSFORM = from_origin(320000, 6840000, 10, 10)
+MONTHS = list(range(4, 11))
+
+
+def _smooth_noise(rng:np.random.Generator, height:int, width:int, scale:int) -> np.ndarray:
+    "private helper that returns spatially correlated noise in [0, 1] with features of about `scale` pixels"
+    coarse = rng.random((height // scale + 2, width // scale + 2))
+    noise = ndimage.zoom(coarse, scale, order=1)[:height, :width]
+    return (noise - noise.min()) / (noise.max() - noise.min())
+
+def _gaps(rng:np.random.Generator, height:int, width:int, cloud_fraction:float) -> np.ndarray:
+    "private helper that returns a gap mask of clouds covering about `cloud_fraction` and sometimes a missing swath"
+    clouds = _smooth_noise(rng, height, width, 64)
+    gaps = clouds > np.quantile(clouds, 1 - cloud_fraction)
+    if rng.random() < 0.2:
+        rows, cols = np.ogrid[:height, :width]
+        gaps |= rows * rng.uniform(0.5, 2) + cols > rng.uniform(0.5, 1.5) * width
+    return gaps
+
+def synthetic_mosaics(inpath:Path, ndindex:str, years:list, height:int, width:int,
+                      transform:Affine=SYNTHETIC_TRANSFORM, cloud_fraction:float=0.3, seed:int=0) -> list[Path]:
+    """
+    Write monthly `height`x`width` mosaics of `ndindex` for April to October of `years` to
+    `inpath`, and META mosaics for NDBI. About `cloud_fraction` of each mosaic is nodata.
+    Returns the paths of the index mosaics
+    """
+    rng = np.random.default_rng(seed)
+    landscape = _smooth_noise(rng, height, width, 256)
+    prof = dict(driver='GTiff', height=height, width=width, count=1, dtype='uint8', nodata=0,
+                crs='EPSG:3067', transform=transform, compress='lzw', tiled=True)
+    files = []
+    for year in years:
+        os.makedirs(Path(inpath)/str(year)/ndindex.upper(), exist_ok=True)
+        if ndindex == 'ndbi': os.makedirs(Path(inpath)/str(year)/'META', exist_ok=True)
+        for month in MONTHS:
+            last = calendar.monthrange(year, month)[1]
+            fname = Path(inpath)/str(year)/ndindex.upper()/f'pta_sjp_s2ind_{ndindex}_{year}{month:02d}01_{year}{month:02d}{last}.tif'
+            season = np.sin(np.pi * (month - 3) / 8)
+            vals = 40 + 160 * landscape * season + rng.normal(0, 8, (height, width))
+            vals = vals.clip(0 if ndindex == 'ndbi' else 1, 254).astype(np.uint8)
+            gaps = _gaps(rng, height, width, cloud_fraction)
+            vals[gaps] = 0
+            with rio.open(fname, 'w', **prof) as dest:
+                dest.write(vals, 1)
+            if ndindex == 'ndbi':
+                meta = rng.integers(1, 5, (height, width), dtype=np.uint8)
+                meta[gaps] = 0
+                with rio.open(meta_file(fname), 'w', **prof) as dest:
+                    dest.write(meta, 1)
+            files.append(fname)
+    return files
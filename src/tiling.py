@@ -0,0 +1,88 @@
+import os
+import tempfile
+import numpy as np
+import rasterio.features as rio_features
+import rasterio.windows as rio_windows
+import geopandas as gpd
+from affine import Affine
+from dataclasses import dataclass
+from itertools import product
+from pathlib import Path
+from shapely.geometry import box
+from shapely.prepared import prep
+
+"""
+Tile grid planning. The grid is computed once, each tile is classified against Finnish borders
+and the border mask of partially covered tiles is rasterized, so that workers get only the tiles
+that need processing and clip them in memory.
+"""
+
+__all__ = ['Tile', 'plan_tiles', 'shard_tiles']
+
+
+@dataclass
+class Tile:
+    "A `dx`x`dy` window at column `x` and row `y` of the mosaics"
+    x: int
+    y: int
+    dx: int
+    dy: int
+    status: str
+    land: float = 1.
+    mask_path: Path = None
+
+    @property
+    def window(self) -> rio_windows.Window:
+        return rio_windows.Window.from_slices((self.y, self.y+self.dy), (self.x, self.x+self.dx))
+
+    def halo_window(self, halo:int, width:int, height:int) -> rio_windows.Window:
+        "Window of the tile grown by `halo` pixels on each side, within a `width`x`height` raster"
+        return rio_windows.Window.from_slices((max(self.y-halo, 0), min(self.y+self.dy+halo, height)),
+                                              (max(self.x-halo, 0), min(self.x+self.dx+halo, width)))
+
+    @property
+    def name(self) -> str:
+        return f'{self.x}_{self.y}'
+
+    def outside_mask(self) -> np.ndarray:
+        "Boolean mask of pixels outside the borders, None for tiles fully inside"
+        if self.mask_path is None: return None
+        bits = np.load(self.mask_path)
+        return np.unpackbits(bits, count=self.dx*self.dy).reshape(self.dy, self.dx).astype(bool)
+
+
+def plan_tiles(borders:gpd.GeoDataFrame, transform:Affine, width:int, height:int,
+               dx:int, dy:int, plan_path:Path) -> list[Tile]:
+    """
+    Divide a `width`x`height` raster into `dx`x`dy` tiles and classify them as 'outside', 'inside'
+    or 'partial' with respect to `borders`. Masks for partial tiles are saved as packed bits
+    to `plan_path`, replacing existing ones atomically as shards may plan in the same path.
+    """
+    os.makedirs(plan_path, exist_ok=True)
+    border = borders.iloc[0].geometry
+    prepared = prep(border)
+    tiles = []
+    for x, y in product(range(0, width, dx), range(0, height, dy)):
+        tile = Tile(x, y, dx, dy, 'outside', land=0.)
+        bbox = box(*rio_windows.bounds(tile.window, transform))
+        if prepared.contains(bbox):
+            tile.status, tile.land = 'inside', 1.
+        elif prepared.intersects(bbox):
+            outside = rio_features.geometry_mask(borders.geometry, out_shape=(dy, dx),
+                                                 transform=rio_windows.transform(tile.window, transform))
+            tile.land = float(1 - outside.mean())
+            if tile.land > 0:
+                tile.status = 'partial'
+                tile.mask_path = plan_path/f'outside_{tile.name}.npy'
+                with tempfile.NamedTemporaryFile(dir=plan_path, suffix='.npy', delete=False) as f:
+                    np.save(f, np.packbits(outside))
+                os.replace(f.name, tile.mask_path)
+        tiles.append(tile)
+    return tiles
+
+def shard_tiles(tiles:list[Tile], shard:int, shards:int) -> list[Tile]:
+    """Tiles of `shard` out of `shards`, dealt in order of decreasing land fraction so that the
+    shards get a similar amount of work. The split depends only on the plan, so independent
+    processes get disjoint shards"""
+    if not 0 <= shard < shards: raise ValueError(f'Shard {shard} is not within 0..{shards-1}')
+    return sorted(tiles, key=lambda t: (-t.land, t.x, t.y))[shard::shards]
@@ -0,0 +1,96 @@
+import os
+import logging
+import numpy as np
+import rasterio as rio
+import rasterio.features as rio_features
+import rasterio.windows as rio_windows
+from pathlib import Path
+from shapely.geometry import mapping
+from shapely.geometry.base import BaseGeometry
+from .cube import mosaic_date
+from .reader import prefetch
+
+"""
+Time-series product of the filled monthly mosaics and queries on it. The mosaics of all filled
+years are stacked into one GeoTIFF with a band per month, interleaved by pixel and tiled in
+small blocks, so that the whole series of a pixel is in a single compressed block. A pixel
+query decodes one block and a polygon query the blocks under the polygon, instead of reading
+a block from each of the monthly mosaics.
+"""
+
+__all__ = ['TIMESERIES', 'TIMESERIES_BLOCK', 'timeseries_memory', 'build_timeseries', 'TimeSeries']
+
+TIMESERIES = 'timeseries.tif'
+TIMESERIES_BLOCK = 128
+
+
+def timeseries_memory(width:int, bands:int) -> int:
+    "Estimate of the memory for building a time series of `bands` mosaics `width` pixels wide"
+    return 3 * TIMESERIES_BLOCK * width * bands
+
+def build_timeseries(files:list, fname:Path, codec:str='deflate') -> None:
+    """Stack monthly mosaics `files` into the time series `fname`, with the bands in order of date
+    and described by their year and month. The mosaics are read one row of blocks at a time"""
+    logging.info(f'Creating time series {Path(fname).parts[-2]}/{Path(fname).name}')
+    files = sorted(files, key=mosaic_date)
+    with rio.open(files[0]) as src:
+        prof = src.profile.copy()
+    prof.update(count=len(files), interleave='pixel', tiled=True, blockxsize=TIMESERIES_BLOCK,
+                blockysize=TIMESERIES_BLOCK, compress=codec, predictor=2, BIGTIFF='YES')
+    tmp_file = Path(fname).with_suffix('.tmp.tif')
+    with rio.open(tmp_file, 'w', **prof) as dest:
+        for i, f in enumerate(files):
+            dest.set_band_description(i+1, '{}-{:02d}'.format(*mosaic_date(f)))
+        for row in range(0, prof['height'], TIMESERIES_BLOCK):
+            window = rio_windows.Window(0, row, prof['width'], min(TIMESERIES_BLOCK, prof['height'] - row))
+            def read(f):
+                with rio.open(f) as src:
+                    return src.read(1, window=window)
+            dest.write(np.array(list(prefetch(read, files))), window=window)
+    os.replace(tmp_file, fname)
+    return
+
+
+class TimeSeries:
+    """
+    Queries on a time series made by `build_timeseries`. The file is kept open, so that repeated
+    queries only decode the blocks they need. Coordinates are in the CRS of the mosaics, and
+    values equal to nodata are masked.
+    """
+    def __init__(self, fname:Path):
+        self.src = rio.open(fname)
+        self.dates = list(self.src.descriptions)
+
+    def __enter__(self): return self
+
+    def __exit__(self, *args): self.close()
+
+    def close(self) -> None:
+        self.src.close()
+
+    def pixel(self, x:float, y:float) -> np.ma.MaskedArray:
+        "Monthly values of the pixel at `x`, `y`"
+        row, col = self.src.index(x, y)
+        if not (0 <= row < self.src.height and 0 <= col < self.src.width):
+            raise ValueError(f'Point {x}, {y} is outside the time series')
+        return self.src.read(window=rio_windows.Window(col, row, 1, 1), masked=True)[:, 0, 0]
+
+    def pixels(self, xs:list, ys:list) -> np.ma.MaskedArray:
+        "Monthly values of the pixels at `xs`, `ys` as a (point, month) array"
+        return np.ma.array([self.pixel(x, y) for x, y in zip(xs, ys)])
+
+    def polygon(self, geom:BaseGeometry, stats:tuple=('mean', 'median', 'min', 'max', 'count')) -> dict:
+        """Monthly `stats` of the valid pixels whose centers are within polygon `geom`. Returns a dict
+        of stat and its values by month, masked for months without valid pixels"""
+        bounds = rio_windows.from_bounds(*geom.bounds, transform=self.src.transform)
+        col, row = int(np.floor(bounds.col_off)), int(np.floor(bounds.row_off))
+        window = rio_windows.Window(col, row, int(np.ceil(bounds.col_off + bounds.width)) - col,
+                                    int(np.ceil(bounds.row_off + bounds.height)) - row)
+        window = window.intersection(rio_windows.Window(0, 0, self.src.width, self.src.height))
+        vals = self.src.read(window=window, masked=True)
+        outside = rio_features.geometry_mask([mapping(geom)], out_shape=vals.shape[1:],
+                                             transform=self.src.window_transform(window))
+        vals = np.ma.array(vals, mask=vals.mask | outside).reshape(vals.shape[0], -1)
+        funcs = {'mean': np.ma.mean, 'median': np.ma.median, 'min': np.ma.min, 'max': np.ma.max,
+                 'count': np.ma.count}
+        return {stat: funcs[stat](vals, axis=1) for stat in stats}
@@ -0,0 +1,85 @@
+import numpy as np
+import zarr
+from pathlib import Path
+from zarr.codecs import BloscCodec
+from .cube import mosaic_date
+from .tiling import Tile
+
+"""
+Zarr output backend. All products of an index are written to one chunked store instead of a
+GeoTIFF per product: base mosaics as `base` (season, y, x), filled mosaics as `interp` (year,
+month, y, x) and stats as `stats` (year, stat, y, x) for the uint8 stats and `stats_int16` for
+sum and amplitude. Chunks divide the tiles, so tile workers write their own chunks in parallel
+without locks, and the store needs no merge or finishing step. Dimensions are named for xarray.
+"""
+
+__all__ = ['ZARR_STORE', 'UINT8_STATS', 'INT16_STATS', 'store_layout', 'create_store', 'ZarrProducts']
+
+ZARR_STORE = 'products.zarr'
+SEASONS = ['spring', 'autumn', 'all']
+UINT8_STATS = ['mean', 'median', 'min', 'max', 'quantile_10', 'quantile_25']
+INT16_STATS = ['sum', 'amp']
+# Chunks are the largest divisors of the tile size up to this many pixels per side
+CHUNK_SIZE = 2048
+
+
+def _chunk(size:int) -> int:
+    "private helper that returns the largest divisor of tile side `size` that is at most `CHUNK_SIZE`"
+    return max(d for d in range(1, min(size, CHUNK_SIZE) + 1) if size % d == 0)
+
+def store_layout(prof:dict, years:list, months:list, dx:int, dy:int) -> dict:
+    "Layout of the store for mosaics with profile `prof`, filled for `years` and `months`, written in `dx`x`dy` tiles"
+    return {'years': list(years), 'months': list(months), 'width': prof['width'], 'height': prof['height'],
+            'tile': [dx, dy]}
+
+def create_store(fname:Path, prof:dict, years:list, months:list, dx:int, dy:int) -> None:
+    """Create Zarr store `fname` for the products of mosaics with profile `prof`, filled for `years`,
+    with chunks that divide `dx`x`dy` tiles and compressed with blosc zstd. An existing store with
+    the same layout is kept, so that its products can be updated tile by tile"""
+    layout = store_layout(prof, years, months, dx, dy)
+    if Path(fname).exists() and {k: v for k, v in zarr.open_group(fname, mode='r').attrs.items() if k in layout} == layout:
+        return
+    group = zarr.open_group(fname, mode='w')
+    group.attrs.update(layout, crs=prof['crs'].to_wkt(), transform=list(prof['transform'])[:6], nodata=prof['nodata'],
+                       seasons=SEASONS, stats=UINT8_STATS, stats_int16=INT16_STATS)
+    compressors = BloscCodec(cname='zstd', clevel=5, shuffle='bitshuffle')
+    yx = (prof['height'], prof['width'])
+    chunks = (1, 1, _chunk(dy), _chunk(dx))
+    group.create_array('base', shape=(len(SEASONS), *yx), chunks=chunks[1:], dtype='uint8', fill_value=prof['nodata'],
+                       compressors=compressors, dimension_names=['season', 'y', 'x'])
+    group.create_array('interp', shape=(len(years), len(months), *yx), chunks=chunks, dtype='uint8',
+                       fill_value=prof['nodata'], compressors=compressors, dimension_names=['year', 'month', 'y', 'x'])
+    group.create_array('stats', shape=(len(years), len(UINT8_STATS), *yx), chunks=chunks, dtype='uint8',
+                       fill_value=prof['nodata'], compressors=compressors, dimension_names=['year', 'stat', 'y', 'x'])
+    group.create_array('stats_int16', shape=(len(years), len(INT16_STATS), *yx), chunks=chunks, dtype='int16',
+                       fill_value=-999, compressors=compressors, dimension_names=['year', 'stat', 'y', 'x'])
+    return
+
+
+class ZarrProducts:
+    "Writes products of `national_products`, given by their GeoTIFF paths, to their place in Zarr store `fname`"
+    def __init__(self, fname:Path):
+        self.group = zarr.open_group(fname, mode='r+')
+        self.years, self.months = self.group.attrs['years'], self.group.attrs['months']
+
+    def _index(self, fname:Path) -> tuple[str, tuple]:
+        "Array and leading indices of product `fname`"
+        fname = Path(fname)
+        if fname.parent.parent.name == 'interp':
+            year, month = mosaic_date(fname)
+            return 'interp', (self.years.index(year), self.months.index(month))
+        if fname.parent.parent.name == 'stats':
+            year = self.years.index(int(fname.parent.name))
+            if fname.stem in INT16_STATS: return 'stats_int16', (year, INT16_STATS.index(fname.stem))
+            return 'stats', (year, UINT8_STATS.index(fname.stem))
+        return 'base', (SEASONS.index(fname.stem.split('_')[1]),)
+
+    def write(self, fname:Path, vals:np.ndarray, nodata:int, tile:Tile, outside:np.ndarray=None) -> None:
+        "Write `vals` of product `fname` to the chunks of `tile`, setting pixels `outside` Finnish borders to nodata"
+        if outside is not None:
+            vals = np.where(outside, nodata, vals)
+        name, index = self._index(fname)
+        array = self.group[name]
+        rows, cols = min(tile.dy, array.shape[-2] - tile.y), min(tile.dx, array.shape[-1] - tile.x)
+        array[(*index, slice(tile.y, tile.y+rows), slice(tile.x, tile.x+cols))] = vals[:rows, :cols]
+        return